@@ -0,0 +1,113 @@
+"""Checks that peak memory of the dashboard pipeline stays within a tolerance as the number of dashboards grows.
+
+Each dashboard count runs in a fresh process that streams synthetic dashboards through the pipeline and reports its
+peak RSS. The dashboards draw their metrics from a pool that the smallest count already covers, so memory that still
+grows with the count is held per dashboard rather than per distinct metric. The benchmark exits with an error when the
+peak RSS of any count exceeds the one of the first count by more than --tolerance. With --source folder the dashboards are read from a folder by handle_dashboards, with --source grafana they
+are fetched from a local Grafana stand-in by get_total_metrics_count. The stand-in runs in the parent process, so only
+the extractor's memory is measured.
+Run from the repository root: python3 benchmarks/memory_benchmark.py --source grafana
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+from stub_servers import GrafanaStub
+from synthetic_dashboards import generate_dashboards
+
+DEFAULT_DASHBOARD_COUNTS = [100, 500, 2000]
+DEFAULT_PANELS = 100
+DEFAULT_TOLERANCE = 0.1
+METRIC_POOL_SIZE = 1000
+SOURCE_FOLDER = 'folder'
+SOURCE_GRAFANA = 'grafana'
+PROC_STATUS_PATH = '/proc/self/status'
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss survives exec on Linux, so it would include the parent's RSS when it forked the child
+    if os.path.exists(PROC_STATUS_PATH):
+        with open(PROC_STATUS_PATH) as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_child(source, location):
+    import logging
+    import metrics_dashboard_extractor
+
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if source == SOURCE_GRAFANA:
+            metrics = metrics_dashboard_extractor.get_total_metrics_count({'grafana': {'endpoint': location,
+                                                                                       'token': 'benchmark'}})
+        else:
+            os.chdir(location)
+            metrics = metrics_dashboard_extractor.handle_dashboards(
+                metrics_dashboard_extractor.get_dashboards_from_folder())
+    print(json.dumps({'distinct_metrics': len(metrics), 'peak_rss_mb': round(_peak_rss_mb(), 1)}))
+
+
+def _run_child_process(source, location) -> dict:
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--source', source, '--child', location],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(source, count, panels) -> dict:
+    if source == SOURCE_GRAFANA:
+        with GrafanaStub(list(generate_dashboards(count, panels=panels, complexity=2, metric_pool_size=METRIC_POOL_SIZE))) as grafana:
+            return _run_child_process(source, grafana.url)
+    with tempfile.TemporaryDirectory() as folder:
+        write_dashboards(folder, count, panels)
+        return _run_child_process(source, folder)
+
+
+def write_dashboards(folder, count, panels):
+    dashboards_folder = os.path.join(folder, 'dashboards')
+    os.makedirs(dashboards_folder)
+    for dashboard in generate_dashboards(count, panels=panels, complexity=2, metric_pool_size=METRIC_POOL_SIZE):
+        with open(os.path.join(dashboards_folder, f"{dashboard['uid']}.json"), 'w') as dashboard_file:
+            json.dump(dashboard, dashboard_file)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=DEFAULT_DASHBOARD_COUNTS)
+    parser.add_argument('--panels', type=int, default=DEFAULT_PANELS)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed peak RSS growth over the first count, as a fraction')
+    parser.add_argument('--source', choices=[SOURCE_FOLDER, SOURCE_GRAFANA], default=SOURCE_FOLDER)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args.source, args.child)
+        return
+    print(f'{"dashboards":>10} {"distinct metrics":>17} {"peak RSS (MB)":>14} {"growth":>8}')
+    baseline = None
+    max_growth = 0.0
+    for count in args.counts:
+        result = measure(args.source, count, args.panels)
+        baseline = baseline or result['peak_rss_mb']
+        growth = result['peak_rss_mb'] / baseline - 1
+        max_growth = max(max_growth, growth)
+        print(f'{count:>10} {result["distinct_metrics"]:>17} {result["peak_rss_mb"]:>14} {growth:>8.1%}')
+    if max_growth > args.tolerance:
+        raise SystemExit(f'Peak RSS grew by {max_growth:.1%} across {args.counts} dashboards, '
+                         f'more than the {args.tolerance:.0%} tolerance')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Micro-benchmark of the native PromQL parser against the former Pygments based extraction.
+
+Requires Pygments for the legacy implementation: pip3 install Pygments
+Run from the repository root: python3 benchmarks/promql_parser_benchmark.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers.promql import PromQLLexer
+
+import promql_parser
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'promql_expressions.txt')
+REPEAT = 5
+NUMBER = 20
+
+LEGACY_PROMQL_FUNCTIONS = ['sum', 'sumwithout', 'sumby', 'maxwithout', 'maxby', 'countwithout', 'countby']
+LEGACY_PROMQL_GROUPING_STATEMENTS = ['by(', 'on(', ',', 'group_right(', 'group_left(', 'sum_rate(']
+LEGACY_REGEX_FILTER = '[a-zA-Z_:][a-zA-Z0-9_:]*'
+
+
+def _legacy_find_grouping(query_string):
+    grouping_indices = []
+    for statement in LEGACY_PROMQL_GROUPING_STATEMENTS:
+        indices = [i for i in range(len(query_string)) if query_string.startswith(statement, i)]
+        for idx in indices:
+            grouping_indices.append(idx + len(statement))
+    return grouping_indices
+
+
+def legacy_find_metrics_names(expr):
+    expr = expr.replace(' ', '')
+    rules = [name for name in re.findall(LEGACY_REGEX_FILTER, expr) if ':' in name]
+    names = []
+    grouping = []
+    for ex in highlight(expr, PromQLLexer(), HtmlFormatter()).split('"nv">'):
+        ex = ex.split('<', 1)
+        if ex[0] and ex[0] not in LEGACY_PROMQL_FUNCTIONS:
+            names.append(ex[0])
+    names = list(dict.fromkeys(names))
+    grouping_indices = _legacy_find_grouping(expr)
+    if grouping_indices:
+        for name in names:
+            indices = [i for i in range(len(expr)) if expr.startswith(name, i)]
+            for idx in indices:
+                for g_idx in grouping_indices:
+                    if idx == g_idx:
+                        grouping.append(name)
+    return list(set(names) - set(grouping)), rules
+
+
+def native_find_metrics_names(expr):
+    analysis = promql_parser.analyze(expr)
+    return analysis.metrics, analysis.rules
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path) as corpus:
+        return [line.strip() for line in corpus if line.strip()]
+
+
+def _best_time(func, corpus):
+    timings = timeit.repeat(lambda: [func(expr) for expr in corpus], repeat=REPEAT, number=NUMBER)
+    return min(timings) / (NUMBER * len(corpus))
+
+
+def main():
+    corpus = load_corpus()
+    legacy = _best_time(legacy_find_metrics_names, corpus)
+    native = _best_time(native_find_metrics_names, corpus)
+    print(f'Expressions in corpus: {len(corpus)}')
+    print(f'Legacy (Pygments) per expression: {legacy * 1e6:.1f}us')
+    print(f'Native parser per expression: {native * 1e6:.1f}us')
+    print(f'Speedup: {legacy / native:.1f}x')
+    differences = 0
+    for expr in corpus:
+        legacy_metrics, _ = legacy_find_metrics_names(expr)
+        native_metrics, _ = native_find_metrics_names(expr)
+        if set(legacy_metrics) != set(native_metrics):
+            differences += 1
+            print(f'------------\n{expr}\n  legacy: {sorted(legacy_metrics)}\n  native: {sorted(native_metrics)}')
+    print(f'Expressions with different metric names: {differences}')
+
+
+if __name__ == '__main__':
+    main()
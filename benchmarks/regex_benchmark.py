@@ -0,0 +1,114 @@
+"""Compares the flat alternation regex with the prefix-factored one produced by regex_compiler.
+
+Before timing, both patterns are checked to match exactly the input metric names (a round trip over the names
+plus near-miss variants of them). Match throughput is then measured with Python re on a synthetic sample stream.
+Run from the repository root: python3 benchmarks/regex_benchmark.py
+With --check, only the round trip is checked, over several name sets and chunk lengths and without timing, so it
+can run as a quick correctness gate: python3 benchmarks/regex_benchmark.py --check
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+import regex_compiler
+from synthetic_dashboards import METRIC_PREFIXES, METRIC_SUFFIXES
+
+SUBSYSTEMS = ['cpu', 'memory', 'disk', 'network', 'filesystem', 'deployment', 'pod', 'request', 'gc', 'tsdb']
+MEASURES = ['usage', 'status', 'errors', 'duration', 'capacity', 'allocatable', 'replicas', 'restarts']
+CHECK_METRIC_COUNTS = [1, 10, 300, 3000]
+CHECK_SEEDS = [0, 1, 2]
+CHUNK_LENGTHS = (1000, 10000)
+# Names that are prefixes of each other, differ by one character or hold recording rule colons
+EDGE_CASE_NAMES = ['up', 'u', 'upx', 'a', 'ab', 'abc', 'abd', 'a_b', 'a_bc', 'job:a:rate5m', 'job:a:rate5m_total',
+                   'node_cpu', 'node_cpu_seconds', 'node_cpu_seconds_total', 'node_cpu_guest_seconds_total']
+
+
+def generate_metric_names(count, seed=0) -> list:
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        names.add('_'.join([rng.choice(METRIC_PREFIXES), rng.choice(SUBSYSTEMS), rng.choice(MEASURES),
+                            f'v{rng.randrange(count)}', rng.choice(METRIC_SUFFIXES)]))
+    return sorted(names)
+
+
+def near_misses(names) -> list:
+    misses = set()
+    for name in names:
+        misses.update([name[:-1], name + '_', name + 'x', 'x' + name, name.replace('_', ':', 1)])
+    return sorted(misses - set(names))
+
+
+def check_round_trip(pattern, names, misses):
+    compiled = re.compile(pattern)
+    unmatched = [name for name in names if not compiled.fullmatch(name)]
+    matched_misses = [name for name in misses if compiled.fullmatch(name)]
+    if unmatched or matched_misses:
+        raise AssertionError(f'Pattern does not match exactly the input set, unmatched: {unmatched[:5]}, '
+                             f'wrongly matched: {matched_misses[:5]}')
+
+
+def check_name_set(names) -> int:
+    """Round trip of the flat, factored and chunked patterns of names; returns the number of near misses checked."""
+    misses = near_misses(names)
+    check_round_trip('|'.join(re.escape(name) for name in names), names, misses)
+    check_round_trip(regex_compiler.compile_regex(names), names, misses)
+    for chunk_length in CHUNK_LENGTHS:
+        chunks = regex_compiler.compile_regex_chunks(names, chunk_length)
+        check_round_trip('|'.join(f'(?:{chunk})' for chunk in chunks), names, misses)
+    return len(misses)
+
+
+def run_checks():
+    name_sets = [EDGE_CASE_NAMES] + [generate_metric_names(count, seed)
+                                     for count in CHECK_METRIC_COUNTS for seed in CHECK_SEEDS]
+    for names in name_sets:
+        check_name_set(names)
+    print(f'Round trip check passed for {len(name_sets)} name sets')
+
+
+def measure_throughput(pattern, samples) -> float:
+    compiled = re.compile(pattern)
+    started_at = time.perf_counter()
+    for sample in samples:
+        compiled.fullmatch(sample)
+    return len(samples) / (time.perf_counter() - started_at)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics', type=int, default=3000)
+    parser.add_argument('--samples', type=int, default=200000)
+    parser.add_argument('--match-ratio', type=float, default=0.3,
+                        help='share of samples whose metric name is in the kept set')
+    parser.add_argument('--check', action='store_true', help='only check the round trip, without timing')
+    args = parser.parse_args()
+    if args.check:
+        run_checks()
+        return
+
+    names = generate_metric_names(args.metrics)
+    misses_count = check_name_set(names)
+    print(f'Round trip check passed for {len(names)} names and {misses_count} near misses')
+    flat = '|'.join(re.escape(name) for name in names)
+    factored = regex_compiler.compile_regex(names)
+
+    rng = random.Random(1)
+    unused_names = generate_metric_names(args.metrics * 2, seed=1)
+    samples = [rng.choice(names) if rng.random() < args.match_ratio else rng.choice(unused_names)
+               for _ in range(args.samples)]
+    flat_throughput = measure_throughput(flat, samples)
+    factored_throughput = measure_throughput(factored, samples)
+    print(f'Flat pattern: {len(flat)} characters, {flat_throughput:,.0f} samples/s')
+    print(f'Factored pattern: {len(factored)} characters, {factored_throughput:,.0f} samples/s')
+    print(f'Speedup: {factored_throughput / flat_throughput:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
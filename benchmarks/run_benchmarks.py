@@ -0,0 +1,179 @@
+"""Timed benchmarks of the extractor stages, recorded as JSON so runs can be compared between versions.
+
+Covers PromQL metric extraction (_find_metrics_names), the dashboard pipeline (handle_dashboards), the Grafana
+pipeline end to end (get_total_metrics_count) against a local Grafana stand-in, and time series counting
+(get_prometheus_timeseries_count) with each count strategy against a local Prometheus stand-in.
+Run from the repository root: python3 benchmarks/run_benchmarks.py --output results.json [--compare previous.json]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+
+import metrics_dashboard_extractor
+import report_writer
+import timeseries_extractor
+from extract import SCRIPT_VERSION
+from stub_servers import GrafanaStub, PrometheusStub
+from synthetic_dashboards import generate_dashboards
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _null_report():
+    return report_writer.TextReportWriter(stream=io.StringIO())
+
+
+def _time_runs(run, repeat) -> list:
+    durations = []
+    for _ in range(repeat):
+        metrics_dashboard_extractor.EXPRESSION_CACHE.clear()
+        started_at = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+def _summarize(durations, items, **extra) -> dict:
+    median = statistics.median(durations)
+    return dict({'runs': durations, 'min': min(durations), 'median': median, 'mean': statistics.mean(durations),
+                 'items': items, 'items_per_second': items / median if median else None}, **extra)
+
+
+def _expressions(dashboards) -> list:
+    return [target['expr'] for dashboard in dashboards for panel in dashboard['panels']
+            for target in panel['targets']]
+
+
+def benchmark_find_metrics_names(dashboards, repeat) -> dict:
+    expressions = _expressions(dashboards)
+
+    def run():
+        for expr in expressions:
+            metrics_dashboard_extractor._find_metrics_names(expr)
+
+    return _summarize(_time_runs(run, repeat), len(expressions))
+
+
+def benchmark_handle_dashboards(dashboards, repeat) -> dict:
+    durations = _time_runs(lambda: metrics_dashboard_extractor.handle_dashboards(dashboards, _null_report()), repeat)
+    return _summarize(durations, len(dashboards))
+
+
+def benchmark_get_total_metrics_count(dashboards, args, repeat):
+    with GrafanaStub(dashboards, args.latency, args.error_rate) as grafana:
+        config = {'grafana': {'endpoint': grafana.url, 'token': 'benchmark', 'concurrency': args.concurrency}}
+        results = []
+        durations = _time_runs(
+            lambda: results.append(metrics_dashboard_extractor.get_total_metrics_count(config, _null_report())), repeat)
+        summary = _summarize(durations, len(dashboards), requests=grafana.requests, injected_errors=grafana.errors)
+    return summary, results[-1]
+
+
+def benchmark_get_prometheus_timeseries_count(metrics, args, repeat) -> dict:
+    # Every used metric has series, plus as many unused metrics again
+    series_counts = {metric: 1 + len(metric) % 50 for metric in metrics}
+    series_counts.update({f'unused_metric_{index}': 10 for index in range(len(metrics))})
+    summaries = {}
+    with PrometheusStub(series_counts, args.latency, args.error_rate) as prometheus:
+        for strategy in timeseries_extractor.COUNT_STRATEGIES:
+            config = {'prometheus': {'endpoint': prometheus.url, 'count_strategy': strategy,
+                                     'max_concurrency': args.concurrency}}
+            requests_before, errors_before = prometheus.requests, prometheus.errors
+            durations = _time_runs(lambda: timeseries_extractor.get_prometheus_timeseries_count(config, metrics),
+                                   repeat)
+            summaries[strategy] = _summarize(durations, len(metrics),
+                                             requests=(prometheus.requests - requests_before) // repeat,
+                                             injected_errors=prometheus.errors - errors_before)
+    return summaries
+
+
+def run_benchmarks(args) -> dict:
+    dashboards = list(generate_dashboards(args.dashboards, args.panels, args.complexity, args.duplication_rate,
+                                          args.seed))
+    results = {
+        'find_metrics_names': benchmark_find_metrics_names(dashboards, args.repeat),
+        'handle_dashboards': benchmark_handle_dashboards(dashboards, args.repeat),
+    }
+    expected_metrics = metrics_dashboard_extractor.handle_dashboards(dashboards, _null_report())
+    results['get_total_metrics_count'], metrics = benchmark_get_total_metrics_count(dashboards, args, args.repeat)
+    if metrics != expected_metrics:
+        raise AssertionError('get_total_metrics_count returned different metrics than handle_dashboards')
+    for strategy, summary in benchmark_get_prometheus_timeseries_count(metrics, args, args.repeat).items():
+        results[f'get_prometheus_timeseries_count.{strategy}'] = summary
+    return {
+        'version': RESULTS_FORMAT_VERSION,
+        'script_version': SCRIPT_VERSION,
+        'git_commit': _git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': results,
+    }
+
+
+def print_results(report, baseline=None):
+    baseline_results = (baseline or {}).get('results', {})
+    header = f'{"benchmark":45} {"median s":>10} {"items/s":>12}'
+    print(header + (f' {"baseline s":>11} {"change":>8}' if baseline else ''))
+    for name, result in report['results'].items():
+        line = f'{name:45} {result["median"]:10.4f} {result["items_per_second"] or 0:12,.0f}'
+        previous = baseline_results.get(name)
+        if previous:
+            change = (result['median'] - previous['median']) / previous['median'] * 100
+            line += f' {previous["median"]:11.4f} {change:+7.1f}%'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dashboards', type=int, default=200)
+    parser.add_argument('--panels', type=int, default=20)
+    parser.add_argument('--complexity', type=int, default=2, help='selectors per panel expression')
+    parser.add_argument('--duplication-rate', type=float, default=0.3,
+                        help='share of panels reusing an expression from a common pool')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stub server response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of stub server responses replaced by 503 errors')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--compare', help='results json file of a previous run to compare with')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    report = run_benchmarks(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
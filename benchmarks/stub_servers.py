@@ -0,0 +1,197 @@
+"""Local stand-ins for the Grafana and Prometheus HTTP APIs used by the benchmarks.
+
+Both servers run on a free local port in a background thread. Every request can be delayed by a fixed latency,
+and a share of requests (error_rate) is answered with 503 and Retry-After: 0 to exercise the retry paths.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+METRIC_NAME_MATCHER_REGEX = r'__name__=~"((?:[^"\\]|\\.)*)"'
+LABELS_MATCH_REGEX = r'__name__="([^"]*)"'
+COUNT_BY_LABELS_REGEX = r'^count by \(__name__\)\(count by \(__name__, ([^)]*)\)'
+COUNT_WITHOUT_LABEL_REGEX = r'^count by \((\w+)\)\(count without \((\w+)\)'
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status_code, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle(self, params):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency)
+        if stub.should_fail():
+            return self._reply(503, {'status': 'error', 'error': 'injected error'}, {'Retry-After': '0'})
+        status_code, body = stub.route(urlparse(self.path).path, params)
+        self._reply(status_code, body)
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(self.rfile.read(length).decode()))
+        self._handle(params)
+
+
+class StubServer:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            failed = bool(self.error_rate) and self._rng.random() < self.error_rate
+            self.errors += failed
+            return failed
+
+    def route(self, path, params):
+        raise NotImplementedError
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class GrafanaStub(StubServer):
+    """Serves /api/search (with limit/page), /api/dashboards/uid/<uid> and its /versions."""
+
+    def __init__(self, dashboards, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.dashboards = {dashboard['uid']: dashboard for dashboard in dashboards}
+        self.hits = [{'type': 'dash-db', 'uid': dashboard['uid'], 'title': dashboard['title']}
+                     for dashboard in dashboards]
+
+    def route(self, path, params):
+        if path == '/api/search':
+            limit = int(params.get('limit', [len(self.hits) or 1])[0])
+            page = int(params.get('page', ['1'])[0])
+            return 200, self.hits[(page - 1) * limit:page * limit]
+        parts = path.strip('/').split('/')
+        if len(parts) >= 4 and parts[:3] == ['api', 'dashboards', 'uid'] and parts[3] in self.dashboards:
+            dashboard = self.dashboards[parts[3]]
+            if len(parts) == 5 and parts[4] == 'versions':
+                return 200, [{'version': dashboard.get('version', 1), 'created': '2024-01-01T00:00:00Z'}]
+            return 200, {'meta': {'version': dashboard.get('version', 1)}, 'dashboard': dashboard}
+        return 404, {'message': 'Not found'}
+
+
+class PrometheusStub(StubServer):
+    """Serves instant count queries over a fixed set of metric names, the TSDB status API and the recording rules of
+    recording_rules, a map of record name to expression.
+
+    label_cardinalities, a map of metric to {label: distinct values}, gives the metrics label names served by
+    /api/v1/labels. Their series are every combination of the label values, which count by and count without
+    label queries are answered from.
+    """
+
+    def __init__(self, series_counts, latency=0.0, error_rate=0.0, seed=0, recording_rules=None,
+                 label_cardinalities=None):
+        super().__init__(latency, error_rate, seed)
+        self.series_counts = dict(series_counts)
+        self.recording_rules = dict(recording_rules or {})
+        self.label_cardinalities = dict(label_cardinalities or {})
+
+    def _grouped_count(self, metric, labels) -> int:
+        cardinalities = self.label_cardinalities.get(metric)
+        if cardinalities is None:
+            return self.series_counts[metric]
+        count = 1
+        for label in labels:
+            count *= cardinalities.get(label, 1)
+        return count
+
+    def _matching_metrics(self, query) -> list:
+        match_obj = re.search(METRIC_NAME_MATCHER_REGEX, query)
+        if match_obj is None:
+            return []
+        pattern = match_obj.group(1).replace('\\\\', '\\')
+        # Plain alternations of metric names are looked up directly, so the stub's own cost stays out of the timings
+        names = [re.sub(r'\\(.)', r'\1', name) for name in pattern.split('|')]
+        if all(name in self.series_counts for name in names):
+            return names
+        pattern = re.compile(pattern)
+        return [metric for metric in self.series_counts if pattern.fullmatch(metric)]
+
+    def route(self, path, params):
+        if path == '/api/v1/status/tsdb':
+            return 200, {'status': 'success', 'data': {'seriesCountByMetricName': [
+                {'name': metric, 'value': count} for metric, count in self.series_counts.items()]}}
+        if path == '/api/v1/rules':
+            return 200, {'status': 'success', 'data': {'groups': [{'name': 'stub', 'file': 'stub.yml', 'rules': [
+                {'type': 'recording', 'name': record, 'query': expr, 'health': 'ok'}
+                for record, expr in self.recording_rules.items()]}]}}
+        if path == '/api/v1/labels':
+            match_obj = re.search(LABELS_MATCH_REGEX, params.get('match[]', [''])[0])
+            metric = match_obj.group(1) if match_obj else None
+            labels = ['__name__'] + sorted(self.label_cardinalities.get(metric, {})) \
+                if metric in self.series_counts else []
+            return 200, {'status': 'success', 'data': labels}
+        if path != '/api/v1/query':
+            return 404, {'status': 'error', 'error': 'not found'}
+        query = params.get('query', [''])[0]
+        count_by_labels = re.search(COUNT_BY_LABELS_REGEX, query)
+        count_without_label = re.search(COUNT_WITHOUT_LABEL_REGEX, query)
+        if query.startswith('last_over_time(prometheus_tsdb_head_series'):
+            result = [{'metric': {}, 'value': [time.time(), str(sum(self.series_counts.values()))]}]
+        elif count_by_labels:
+            labels = [label.strip() for label in count_by_labels.group(1).split(',')]
+            result = [{'metric': {'__name__': metric}, 'value': [time.time(), str(self._grouped_count(metric, labels))]}
+                      for metric in self._matching_metrics(query)]
+        elif count_without_label:
+            name_label, dropped_label = count_without_label.groups()
+            result = []
+            for metric in self._matching_metrics(query):
+                labels = [label for label in self.label_cardinalities.get(metric, {}) if label != dropped_label]
+                result.append({'metric': {name_label: metric},
+                               'value': [time.time(), str(self._grouped_count(metric, labels))]})
+        elif query.startswith('count by (__name__)'):
+            result = [{'metric': {'__name__': metric}, 'value': [time.time(), str(self.series_counts[metric])]}
+                      for metric in self._matching_metrics(query)]
+        else:
+            total = sum(self.series_counts[metric] for metric in self._matching_metrics(query))
+            result = [{'metric': {}, 'value': [time.time(), str(total)]}] if total else []
+        return 200, {'status': 'success', 'data': {'resultType': 'vector', 'result': result}}
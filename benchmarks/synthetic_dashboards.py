@@ -0,0 +1,57 @@
+"""Generates synthetic Grafana dashboards for the benchmarks."""
+import random
+
+METRIC_PREFIXES = ['node', 'kube', 'container', 'http', 'process', 'go', 'prometheus', 'apiserver']
+METRIC_SUFFIXES = ['total', 'seconds', 'bytes', 'count', 'ratio', 'info']
+LABELS = ['job', 'instance', 'namespace', 'pod', 'container', 'mode', 'device', 'code', 'le']
+EXPRESSION_TEMPLATES = [
+    '{metric}{{{label}="$var"}}',
+    'rate({metric}{{{label}=~"$var"}}[5m])',
+    'sum by ({label}) (rate({metric}[$__rate_interval]))',
+    'histogram_quantile(0.99, sum by (le, {label}) (rate({metric}_bucket[5m])))',
+    'sum without ({label}) ({metric}) / on({label}) group_left {other}',
+]
+
+
+def metric_name(rng, metric_pool_size):
+    index = rng.randrange(metric_pool_size)
+    return f'{METRIC_PREFIXES[index % len(METRIC_PREFIXES)]}_metric_{index}_{METRIC_SUFFIXES[index % len(METRIC_SUFFIXES)]}'
+
+
+def generate_expression(rng, complexity=1, metric_pool_size=5000):
+    parts = []
+    for _ in range(max(1, complexity)):
+        template = rng.choice(EXPRESSION_TEMPLATES)
+        parts.append(template.format(metric=metric_name(rng, metric_pool_size), label=rng.choice(LABELS),
+                                     other=metric_name(rng, metric_pool_size)))
+    return ' + '.join(parts)
+
+
+def generate_dashboard(index, panels=20, complexity=1, duplication_rate=0.0, seed=0, metric_pool_size=5000,
+                       shared_expressions=None):
+    rng = random.Random(seed * 1000003 + index)
+    panel_list = []
+    for panel_id in range(panels):
+        if shared_expressions and rng.random() < duplication_rate:
+            expr = rng.choice(shared_expressions)
+        else:
+            expr = generate_expression(rng, complexity, metric_pool_size)
+        panel_list.append({'id': panel_id, 'type': 'timeseries', 'title': f'Panel {panel_id}',
+                           'targets': [{'expr': expr, 'refId': 'A', 'legendFormat': '{{instance}}'}]})
+    return {
+        'uid': f'synthetic-{index}',
+        'title': f'Synthetic dashboard {index}',
+        'version': 1,
+        'templating': {'list': [{'type': 'query', 'name': 'var',
+                                 'query': f'label_values({metric_name(rng, metric_pool_size)}, job)'}]},
+        'panels': panel_list,
+    }
+
+
+def generate_dashboards(count, panels=20, complexity=1, duplication_rate=0.0, seed=0, metric_pool_size=5000):
+    """Yields dashboards one at a time; a duplication_rate share of panels reuse a common pool of expressions."""
+    rng = random.Random(seed)
+    shared_expressions = [generate_expression(rng, complexity, metric_pool_size) for _ in range(100)]
+    for index in range(count):
+        yield generate_dashboard(index, panels, complexity, duplication_rate, seed, metric_pool_size,
+                                 shared_expressions)
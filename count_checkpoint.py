@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from dashboard_store import source_path
+
+logger = logging.getLogger()
+
+CHECKPOINT_FORMAT_VERSION = 2
+SAVE_INTERVAL_SECONDS = 10
+DEFAULT_STALE_AFTER_SECONDS = 3600
+
+
+def metrics_digest(metrics) -> str:
+    return hashlib.sha256('\n'.join(sorted(set(metrics))).encode()).hexdigest()
+
+
+class CountCheckpoint:
+    """Progress of a time series count: completed metrics with their counts, and failed metrics with their error.
+
+    A checkpoint is only resumed for the same Prometheus endpoint, count strategy, metric set and interval. Counts
+    older than stale_after seconds and failed metrics are counted again.
+    """
+
+    def __init__(self, path=None, metrics=(), interval=None, stale_after=DEFAULT_STALE_AFTER_SECONDS, endpoint=None,
+                 count_strategy=None):
+        self.path = path
+        self.interval = interval
+        self.endpoint = endpoint
+        self.count_strategy = count_strategy
+        self.digest = metrics_digest(metrics)
+        self.stale_after = stale_after
+        self.created_at = time.time()
+        self.completed = {}
+        self.failed = {}
+        self._unsaved_changes = 0
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, prometheus_config: dict, metrics, interval, count_strategy=None, target=None):
+        """Checkpoint of prometheus.checkpoint. Each of several targets counting concurrently gets its own file."""
+        checkpoint_config = prometheus_config.get('checkpoint') or {}
+        stale_after = checkpoint_config.get('stale_after')
+        path = checkpoint_config.get('path')
+        if path and target:
+            path = source_path(path, target)
+        checkpoint = cls(path, metrics, interval,
+                         DEFAULT_STALE_AFTER_SECONDS if stale_after is None else float(stale_after),
+                         prometheus_config.get('endpoint'), count_strategy)
+        checkpoint.load()
+        return checkpoint
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as checkpoint_file:
+                content = json.load(checkpoint_file)
+        except (OSError, ValueError) as e:
+            logger.error(f'Could not read count checkpoint from {self.path}, counting all metrics: {e}')
+            return
+        if content.get('version') != CHECKPOINT_FORMAT_VERSION:
+            logger.info(f'Count checkpoint at {self.path} has an outdated format, counting all metrics')
+            return
+        if content.get('endpoint') != self.endpoint or content.get('count_strategy') != self.count_strategy:
+            logger.info(f'Count checkpoint at {self.path} was written for another Prometheus endpoint or count '
+                        f'strategy, counting all metrics')
+            return
+        if content.get('interval') != self.interval or content.get('metrics_digest') != self.digest:
+            logger.info(f'Count checkpoint at {self.path} was written for another metric set or interval, '
+                        f'counting all metrics')
+            return
+        self.created_at = content.get('created_at', self.created_at)
+        stale_before = time.time() - self.stale_after
+        self.completed = {metric: entry for metric, entry in content.get('completed', {}).items()
+                          if entry.get('counted_at', 0) >= stale_before}
+        self.failed = content.get('failed', {})
+        stale_count = len(content.get('completed', {})) - len(self.completed)
+        logger.info(f'Resuming from count checkpoint at {self.path}: {len(self.completed)} metrics counted, '
+                    f'{stale_count} stale counts and {len(self.failed)} failed metrics to count again')
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            content = {'version': CHECKPOINT_FORMAT_VERSION, 'endpoint': self.endpoint,
+                       'count_strategy': self.count_strategy, 'interval': self.interval,
+                       'metrics_digest': self.digest, 'created_at': self.created_at, 'updated_at': time.time(),
+                       'completed': dict(self.completed), 'failed': dict(self.failed)}
+            self._unsaved_changes = 0
+            self._saved_at = time.monotonic()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as checkpoint_file:
+                json.dump(content, checkpoint_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f'Could not write count checkpoint to {self.path}: {e}')
+
+    def pending(self, metrics) -> list:
+        """Metrics without a current count."""
+        return [metric for metric in metrics if metric not in self.completed]
+
+    def counts(self) -> (dict, dict):
+        """Checkpointed series counts and the strategy that produced each, for metrics that have series."""
+        counts = {metric: entry['count'] for metric, entry in self.completed.items() if entry['count']}
+        return counts, {metric: self.completed[metric]['source'] for metric in counts}
+
+    def record_counts(self, metrics, counts, source):
+        """Records a completed batch; metrics missing from counts have no series."""
+        counted_at = time.time()
+        with self._lock:
+            for metric in metrics:
+                self.completed[metric] = {'count': int(counts.get(metric, 0)), 'source': source,
+                                          'counted_at': counted_at}
+                self.failed.pop(metric, None)
+        self._changed(len(metrics))
+
+    def record_failure(self, metrics, error):
+        failed_at = time.time()
+        with self._lock:
+            for metric in metrics:
+                self.failed[metric] = {'error': str(error), 'failed_at': failed_at}
+        self._changed(len(metrics))
+
+    def _changed(self, count):
+        with self._lock:
+            self._unsaved_changes += count
+            # The whole checkpoint is rewritten on save, so saves are spaced in time rather than per result
+            should_save = time.monotonic() - self._saved_at >= SAVE_INTERVAL_SECONDS
+        if should_save:
+            self.save()
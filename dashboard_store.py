@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+STORE_FORMAT_VERSION = 4
+SAVE_INTERVAL = 100
+
+
+class DashboardStore:
+    """On-disk map of dashboard uid to its version and extracted metrics, used to skip unchanged dashboards.
+
+    Without a path, entries are only kept when keep_in_memory is set, for a store that outlives one run as in watch
+    mode. Otherwise a run would hold the metrics and panels of every dashboard it fetched for nothing.
+    """
+
+    def __init__(self, path=None, keep_in_memory=False):
+        self.path = path
+        self.keep_in_memory = keep_in_memory
+        self.dashboards = {}
+        self._unsaved_changes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, source=None, keep_in_memory=False):
+        store_config = config.get('dashboard_store') or {}
+        path = store_config.get('path')
+        if path and source:
+            path = source_path(path, source)
+        store = cls(path, keep_in_memory)
+        if store_config.get('invalidate'):
+            logger.info('Dashboard store invalidation requested, all dashboards will be fetched')
+        else:
+            store.load()
+        return store
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as store_file:
+                content = json.load(store_file)
+        except (OSError, ValueError) as e:
+            logger.error(f'Could not read dashboard store from {self.path}, all dashboards will be fetched: {e}')
+            return
+        if content.get('version') != STORE_FORMAT_VERSION:
+            logger.info(f'Dashboard store at {self.path} has an outdated format, all dashboards will be fetched')
+            return
+        self.dashboards = content.get('dashboards', {})
+        logger.info(f'Loaded {len(self.dashboards)} dashboards from the dashboard store')
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            content = {'version': STORE_FORMAT_VERSION, 'dashboards': dict(self.dashboards)}
+            self._unsaved_changes = 0
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as store_file:
+                json.dump(content, store_file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f'Could not write dashboard store to {self.path}: {e}')
+
+    def is_current(self, uid, version) -> bool:
+        entry = self.dashboards.get(uid)
+        return entry is not None and version is not None and entry.get('version') == version
+
+    def get(self, uid) -> dict:
+        return self.dashboards.get(uid)
+
+    def put(self, uid, version, title, metrics, panels=None, labels=None):
+        if not self.path and not self.keep_in_memory:
+            return
+        with self._lock:
+            self.dashboards[uid] = {'version': version, 'title': title,
+                                    'metrics': list(metrics) if metrics is not None else None,
+                                    'panels': panels or [], 'labels': labels or {}}
+            self._unsaved_changes += 1
+            should_save = self._unsaved_changes >= SAVE_INTERVAL
+        if should_save:
+            self.save()
+
+    def retain(self, uids) -> int:
+        uids = set(uids)
+        with self._lock:
+            deleted = [uid for uid in self.dashboards if uid not in uids]
+            for uid in deleted:
+                del self.dashboards[uid]
+        if deleted:
+            logger.info(f'Dropped {len(deleted)} deleted dashboards from the dashboard store')
+        return len(deleted)
+
+
+def source_path(path, source):
+    """path with the source name inserted before its extension, so each source of a shared config gets its own file."""
+    root, extension = os.path.splitext(path)
+    safe_source = ''.join(char if char.isalnum() else '_' for char in source)
+    return f'{root}.{safe_source}{extension}'
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+CACHE_FORMAT_VERSION = 5
+
+
+def normalize_expression(expr) -> str:
+    return ' '.join(str(expr).split())
+
+
+def estimate_size(value) -> int:
+    """Approximate memory held by a cached value: the object and, for containers, their items."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return size + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(item) for item in value)
+    return size
+
+
+class ExpressionCache:
+    """Bounded LRU of analysis results keyed by kind and whitespace-normalized expression.
+
+    Entries are evicted once there are more than max_size of them or their estimated memory exceeds max_bytes, as
+    a few very long expressions can outweigh many short ones.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(kind, expr):
+        return f'{kind}:{normalize_expression(expr)}'
+
+    def get_or_compute(self, kind, expr, compute):
+        key = self._key(kind, expr)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        value = compute(normalize_expression(expr))
+        self._put(key, value)
+        return value
+
+    def _put(self, key, value):
+        size = estimate_size(key) + estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_size or (self.bytes > self.max_bytes and len(self._entries) > 1):
+                self.bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def drain_counts(self) -> dict:
+        """Hits and misses since the last drain, reset so the next drain only holds new lookups."""
+        with self._lock:
+            counts = {'hits': self.hits, 'misses': self.misses}
+            self.hits = 0
+            self.misses = 0
+        return counts
+
+    def add_counts(self, hits=0, misses=0):
+        """Adds lookups counted elsewhere, e.g. drained from a worker process."""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'max_size': self.max_size, 'bytes': self.bytes,
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': round(self.hits / lookups, 4) if lookups else 0}
+
+    def load(self, path):
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as cache_file:
+                content = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.error(f'Could not read expression cache from {path}, starting with an empty cache: {e}')
+            return
+        if content.get('version') != CACHE_FORMAT_VERSION:
+            logger.info(f'Expression cache at {path} has an outdated format, ignoring it')
+            return
+        for key, value in content.get('entries', []):
+            self._put(key, value)
+        logger.info(f'Loaded {len(self._entries)} cached expressions from {path}')
+
+    def save(self, path):
+        if not path:
+            return
+        with self._lock:
+            entries = [(key, value) for key, (value, _) in self._entries.items()]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'version': CACHE_FORMAT_VERSION, 'entries': entries}, cache_file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f'Could not write expression cache to {path}: {e}')
@@ -1,17 +1,53 @@
+import multiprocessing
 import sys
 
+import instrumentation
 import settings_reader
 import metrics_dashboard_extractor
+import multi_source
+import report_writer
 import timeseries_extractor
+import watch_mode
 
 SCRIPT_VERSION = "0.1.2"
 
-if __name__ == '__main__':
-    print(f"*** Running script version {SCRIPT_VERSION} ***")
+
+def run(config):
+    with instrumentation.instrumented_run_from_config(config), report_writer.from_config(config) as report:
+        metrics_dashboard_extractor.load_recording_rules(config)
+        if multi_source.is_multi_source(config):
+            multi_source.run(config, report)
+            return
+        if config.get('logzio'):
+            distinct_metrics = metrics_dashboard_extractor.logzio_api_metrics(config['logzio'], report)
+        elif config.get('dashboards_folder'):
+            distinct_metrics = metrics_dashboard_extractor.handle_dashboards_folder(
+                config['dashboards_folder'], config.get('dashboards_folder_workers'), report)
+        else:
+            distinct_metrics = metrics_dashboard_extractor.get_total_metrics_count(config, report)
+        if config.get('prometheus'):
+            timeseries_extractor.get_prometheus_timeseries_count(config, distinct_metrics, report,
+                                                                 metrics_dashboard_extractor.LABEL_USAGE)
+
+
+def run_interactive():
     menu_choice = settings_reader.read_menu_input()
     if menu_choice == 1:
-        config = settings_reader.get_config()
-        distinct_metrics = metrics_dashboard_extractor.get_total_metrics_count(config)
-        timeseries_extractor.get_prometheus_timeseries_count(config, distinct_metrics)
+        run(settings_reader.get_config())
     elif menu_choice == 2:
-        metrics_dashboard_extractor.logzio_metrics_extractor()
+        with instrumentation.instrumented_run():
+            metrics_dashboard_extractor.logzio_metrics_extractor()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    print(f"*** Running script version {SCRIPT_VERSION} ***")
+    if len(sys.argv) == 1:
+        run_interactive()
+    else:
+        args = settings_reader.parse_args()
+        config = settings_reader.config_from_args(args)
+        if args.watch:
+            watch_mode.watch(config)
+        else:
+            run(config)
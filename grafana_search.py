@@ -0,0 +1,154 @@
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+import requests
+
+logger = logging.getLogger()
+
+DASHBOARD_HIT_TYPE = 'dash-db'
+DEFAULT_PAGE_SIZE = 1000
+RELATIVE_TIME_REGEX = r'^(\d+)([mhdw])$'
+RELATIVE_TIME_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+SEARCH_FILTERS = ['folder_uids', 'folder_ids', 'tags', 'query', 'title_patterns', 'starred', 'modified_since']
+
+
+def build_search_params(search_config: dict) -> dict:
+    """Grafana /api/search parameters for the server side filters in the search config."""
+    params = {'type': DASHBOARD_HIT_TYPE}
+    if search_config.get('folder_uids'):
+        params['folderUIDs'] = list(search_config['folder_uids'])
+    if search_config.get('folder_ids'):
+        params['folderIds'] = list(search_config['folder_ids'])
+    if search_config.get('tags'):
+        params['tag'] = list(search_config['tags'])
+    if search_config.get('query'):
+        params['query'] = search_config['query']
+    if search_config.get('starred'):
+        params['starred'] = 'true'
+    return params
+
+
+def is_filtered(search_config: dict) -> bool:
+    return any(search_config.get(key) for key in SEARCH_FILTERS)
+
+
+def parse_modified_since(value):
+    """Accepts an ISO date or time, or a relative time such as 12h or 7d. Returns an aware datetime."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    match_obj = re.match(RELATIVE_TIME_REGEX, str(value).strip())
+    if match_obj:
+        delta = timedelta(**{RELATIVE_TIME_UNITS[match_obj.group(2)]: int(match_obj.group(1))})
+        return datetime.now(timezone.utc) - delta
+    parsed = _parse_timestamp(str(value))
+    if parsed is None:
+        raise ValueError(f'Invalid modified_since value: {value}, expected an ISO date or a relative time like 7d')
+    return parsed
+
+
+def _parse_timestamp(value):
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def latest_version(version_json):
+    """Latest entry of a /api/dashboards/uid/<uid>/versions response."""
+    if isinstance(version_json, dict):
+        version_json = version_json.get('versions') or []
+    if not version_json:
+        return None
+    return max(version_json, key=lambda version: version.get('version', 0))
+
+
+def _page_url(search_url, params, page_size, page) -> str:
+    return f'{search_url}?{urlencode(dict(params, limit=page_size, page=page), doseq=True)}'
+
+
+def _read_page(response, page_size):
+    """Returns the dashboard hits of a search page, and whether it was the last page."""
+    if response.status_code != 200:
+        logger.error(f'Received status code: {response.status_code}, cannot complete dashboards fetch')
+        raise requests.ConnectionError(response.text)
+    page = response.json()
+    return [hit for hit in page if hit.get('type') == DASHBOARD_HIT_TYPE], len(page) < page_size
+
+
+def _fetch_pages(search_url, params, page_size, fetcher) -> list:
+    hits, is_last = _read_page(fetcher.get(_page_url(search_url, params, page_size, 1)), page_size)
+    if is_last:
+        return hits
+    pages = {1: hits}
+    # The total is unknown up front, so pages are requested in waves until one comes back short
+    next_page = 2
+    last_page = None
+    while last_page is None:
+        urls = {_page_url(search_url, params, page_size, page): page
+                for page in range(next_page, next_page + fetcher.concurrency)}
+        for url, response, error in fetcher.fetch_all(urls):
+            if error is not None:
+                raise requests.ConnectionError(f'Could not fetch search page {urls[url]}: {error}')
+            pages[urls[url]], is_last = _read_page(response, page_size)
+            if is_last and (last_page is None or urls[url] < last_page):
+                last_page = urls[url]
+        next_page += fetcher.concurrency
+    hits = []
+    seen_uids = set()
+    for page in range(1, last_page + 1):
+        for hit in pages[page]:
+            if hit.get('uid') not in seen_uids:
+                seen_uids.add(hit.get('uid'))
+                hits.append(hit)
+    return hits
+
+
+def _filter_titles(hits, title_patterns) -> list:
+    patterns = [re.compile(pattern) for pattern in title_patterns]
+    return [hit for hit in hits if any(pattern.search(hit.get('title', '')) for pattern in patterns)]
+
+
+def _filter_modified_since(base_url, hits, since, fetcher) -> list:
+    """Search hits carry no timestamps, so the latest version of each dashboard is read instead of its json.
+    The version found is kept on the hit to spare the dashboard store another lookup."""
+    urls = {f'{base_url}/api/dashboards/uid/{hit.get("uid")}/versions?limit=1': hit for hit in hits}
+    stale_uids = set()
+    for url, response, error in fetcher.fetch_all(urls):
+        hit = urls[url]
+        if error is not None or response.status_code != 200:
+            logger.error(f'Could not read the versions of dashboard with uid: {hit.get("uid")}, keeping it')
+            continue
+        try:
+            version = latest_version(response.json()) or {}
+        except ValueError:
+            version = {}
+        created = _parse_timestamp(version.get('created') or '')
+        if version.get('version') is not None:
+            hit['version'] = version['version']
+        if created is not None and created < since:
+            stale_uids.add(hit.get('uid'))
+    return [hit for hit in hits if hit.get('uid') not in stale_uids]
+
+
+def search_dashboards(base_url, fetcher, search_config=None) -> list:
+    """Returns the dashboard hits of a Grafana instance, paginated and filtered by the search config."""
+    search_config = search_config or {}
+    search_url = f'{base_url}/api/search'
+    params = build_search_params(search_config)
+    page_size = int(search_config.get('page_size') or DEFAULT_PAGE_SIZE)
+    logger.info(f'Searching dashboards at {search_url} with filters: {params}')
+    hits = _fetch_pages(search_url, params, page_size, fetcher)
+    logger.info(f'Found {len(hits)} dashboards')
+    if search_config.get('title_patterns'):
+        hits = _filter_titles(hits, search_config['title_patterns'])
+        logger.info(f'{len(hits)} dashboards match the title patterns')
+    since = parse_modified_since(search_config.get('modified_since'))
+    if since is not None and hits:
+        hits = _filter_modified_since(base_url, hits, since, fetcher)
+        logger.info(f'{len(hits)} dashboards were modified since {since.isoformat()}')
+    return hits
@@ -0,0 +1,152 @@
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import RUN_STATS, endpoint_name
+
+logger = logging.getLogger()
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_SECOND = 0
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_RETRY_AFTER_SECONDS = 1
+MAX_RETRY_AFTER_SECONDS = 60
+RETRY_AFTER_STATUS_CODES = (429, 503)
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+DEFAULT_READ_TIMEOUT_SECONDS = 60
+
+
+def _parse_retry_after(value) -> float:
+    if not value:
+        return DEFAULT_RETRY_AFTER_SECONDS
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER_SECONDS
+    return min(max(seconds, 0), MAX_RETRY_AFTER_SECONDS)
+
+
+class RateLimiter:
+    """Spaces out request starts across threads and honours server-requested pauses."""
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+        self._interval = 1.0 / requests_per_second if requests_per_second else 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self._interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def create_session(pool_size=DEFAULT_CONCURRENCY, headers=None) -> requests.Session:
+    session = requests.Session()
+    session.hooks['response'].append(RUN_STATS.record_response)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+class ConcurrentFetcher:
+    """Bounded worker pool sharing one keep-alive session and a client side rate limit."""
+
+    def __init__(self, headers=None, concurrency=DEFAULT_CONCURRENCY,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, max_retries=DEFAULT_MAX_RETRIES,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS, read_timeout=DEFAULT_READ_TIMEOUT_SECONDS):
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = max_retries
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.session = create_session(self.concurrency, headers)
+        self.rate_limiter = RateLimiter(requests_per_second)
+
+    @classmethod
+    def from_config(cls, source_config: dict, headers=None):
+        return cls(headers=headers,
+                   concurrency=source_config.get('concurrency') or DEFAULT_CONCURRENCY,
+                   requests_per_second=source_config.get('requests_per_second') or DEFAULT_REQUESTS_PER_SECOND,
+                   connect_timeout=source_config.get('connect_timeout') or DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                   read_timeout=source_config.get('read_timeout') or DEFAULT_READ_TIMEOUT_SECONDS)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        """GET with the fetcher's timeouts, retrying 429/503 responses and timeouts up to max_retries times."""
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.Timeout as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                RUN_STATS.record_retry(endpoint_name('GET', url))
+                retry_after = min(DEFAULT_RETRY_AFTER_SECONDS * 2 ** (attempt - 1), MAX_RETRY_AFTER_SECONDS)
+                logger.warning(f'Request to {url} timed out: {e}, retrying in {retry_after}s (attempt {attempt})')
+                self.rate_limiter.pause(retry_after)
+                continue
+            if response.status_code not in RETRY_AFTER_STATUS_CODES or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            RUN_STATS.record_retry(endpoint_name('GET', url))
+            retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            logger.warning(f'Received status code: {response.status_code} from {url}, '
+                           f'retrying in {retry_after}s (attempt {attempt})')
+            self.rate_limiter.pause(retry_after)
+
+    def fetch_all(self, urls, **kwargs):
+        """Yields (url, response, error) tuples in completion order.
+
+        At most concurrency requests are in flight, and a response is released once yielded, so memory stays bounded
+        by the pool size however many urls there are and however slowly the consumer reads.
+        """
+        urls = iter(urls)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            try:
+                while True:
+                    for url in itertools.islice(urls, self.concurrency - len(futures)):
+                        futures[executor.submit(self.get, url, **kwargs)] = url
+                    if not futures:
+                        return
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url = futures.pop(future)
+                        try:
+                            response, error = future.result(), None
+                        except requests.RequestException as e:
+                            response, error = None, e
+                        yield url, response, error
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,212 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+logger = logging.getLogger()
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+UID_PATH_REGEX = r'/uid/[^/]+'
+TIMINGS_FORMAT_VERSION = 1
+
+
+def endpoint_name(method, url) -> str:
+    """Groups requests by method and path, with dashboard uids replaced by a placeholder."""
+    return f'{method} {re.sub(UID_PATH_REGEX, "/uid/{uid}", urlparse(url).path)}'
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q) -> float:
+        """Upper bound of the bucket holding the q quantile, capped by the largest observed latency."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf',), self.counts)}}
+
+
+class RunStats:
+    """Thread safe collector of stage timings, per endpoint request stats and cache hit rates for one run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.stages = {}
+            self.latencies = {}
+            self.status_codes = {}
+            self.retries = Counter()
+            self.caches = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - started_at)
+
+    def record_stage(self, name, seconds, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stage['calls'] += calls
+            stage['seconds'] += seconds
+
+    def timed_iter(self, name, iterable):
+        """Yields the items of iterable, timing only the work of producing them. A stage around a lazy generator
+        would also time whatever its consumer does between items."""
+        seconds = 0.0
+        calls = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started_at = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started_at
+                calls += 1
+                yield item
+        finally:
+            self.record_stage(name, seconds, calls)
+
+    def drain_stages(self) -> dict:
+        """Stage timings recorded since the last drain, cleared so the next drain only holds new timings."""
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge_stages(self, stages):
+        """Adds stage timings recorded elsewhere, e.g. drained from a worker process."""
+        with self._lock:
+            for name, other in stages.items():
+                stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+                stage['calls'] += other['calls']
+                stage['seconds'] += other['seconds']
+
+    def record_request(self, endpoint, status_code, seconds):
+        with self._lock:
+            self.latencies.setdefault(endpoint, LatencyHistogram()).observe(seconds)
+            self.status_codes.setdefault(endpoint, Counter())[str(status_code)] += 1
+
+    def record_response(self, response, *args, **kwargs):
+        """requests response hook."""
+        self.record_request(endpoint_name(response.request.method, response.url), response.status_code,
+                            response.elapsed.total_seconds())
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self.retries[endpoint] += 1
+
+    def record_cache(self, name, hits, misses):
+        with self._lock:
+            lookups = hits + misses
+            self.caches[name] = {'hits': hits, 'misses': misses,
+                                 'hit_rate': round(hits / lookups, 4) if lookups else 0.0}
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'version': TIMINGS_FORMAT_VERSION,
+                'started_at': self.started_at,
+                'duration': time.time() - self.started_at,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'endpoints': {endpoint: dict(histogram.to_dict(), status_codes=dict(self.status_codes[endpoint]),
+                                             retries=self.retries.get(endpoint, 0))
+                              for endpoint, histogram in self.latencies.items()},
+                'retries': dict(self.retries),
+                'caches': {name: dict(cache) for name, cache in self.caches.items()},
+            }
+
+    def summary_table(self) -> str:
+        lines = [f'Run finished in {time.time() - self.started_at:.2f}s',
+                 f'{"stage":40} {"calls":>8} {"seconds":>10}']
+        lines += [f'{name:40} {stage["calls"]:8} {stage["seconds"]:10.3f}' for name, stage in self.stages.items()]
+        if self.latencies:
+            lines.append(f'{"endpoint":40} {"requests":>8} {"mean s":>10} {"p95 s":>8} {"max s":>8} {"retries":>8}'
+                         f'  status codes')
+            for endpoint, histogram in sorted(self.latencies.items()):
+                status_codes = ', '.join(f'{code}: {count}' for code, count in sorted(self.status_codes[endpoint].items()))
+                lines.append(f'{endpoint:40} {histogram.count:8} {histogram.sum / histogram.count:10.3f} '
+                             f'{histogram.quantile(0.95):8.3f} {histogram.max:8.3f} '
+                             f'{self.retries.get(endpoint, 0):8}  {status_codes}')
+        other_retries = {endpoint: count for endpoint, count in self.retries.items() if endpoint not in self.latencies}
+        lines += [f'{endpoint:40} retries: {count}' for endpoint, count in other_retries.items()]
+        if self.caches:
+            lines.append(f'{"cache":40} {"hits":>8} {"misses":>10} {"hit rate":>8}')
+            lines += [f'{name:40} {cache["hits"]:8} {cache["misses"]:10} {cache["hit_rate"]:8.2%}'
+                      for name, cache in self.caches.items()]
+        return '\n'.join(lines)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as timings_file:
+            json.dump(self.to_dict(), timings_file, indent=2)
+        logger.info(f'Timings written to {path}')
+
+
+RUN_STATS = RunStats()
+
+
+@contextlib.contextmanager
+def instrumented_run(timings_path=None, profile_path=None):
+    """Collects the run's stats, logs the summary table at the end, and optionally profiles the run.
+
+    cProfile only sees the thread that entered the run. Work done by fetcher and query threads, by the threads of
+    several Grafana sources, or by folder worker processes is missing from the profile; the stage timings of the
+    summary table include it.
+    """
+    RUN_STATS.reset()
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield RUN_STATS
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            logger.info(f'Profile written to {profile_path}, view it with: python3 -m pstats {profile_path}')
+        logger.info(f'Run summary:\n{RUN_STATS.summary_table()}')
+        if timings_path:
+            RUN_STATS.save(timings_path)
+
+
+def instrumented_run_from_config(config: dict):
+    instrumentation_config = (config or {}).get('instrumentation') or {}
+    return instrumented_run(instrumentation_config.get('timings_path'), instrumentation_config.get('profile_path'))
@@ -0,0 +1,118 @@
+import logging
+
+import yaml
+
+import regex_compiler
+from promql_parser import ALL_LABELS, METRIC_NAME_LABEL
+
+logger = logging.getLogger()
+
+# Labels read by template queries such as label_values(job), which list the label's values across all metrics
+GLOBAL_LABELS_KEY = ''
+DEFAULT_KEEP_LABELS = ['job', 'instance']
+RELABEL_ACTION_LABELDROP = 'labeldrop'
+RELABEL_ACTION_LABELKEEP = 'labelkeep'
+RELABEL_ACTION_REPLACE = 'replace'
+
+
+def merge_usage(target: dict, usage):
+    """Merges a {metric: labels} usage into target, a map of metric to label set where ALL_LABELS absorbs the
+    other labels."""
+    for metric, labels in (usage or {}).items():
+        current = target.setdefault(metric, set())
+        if ALL_LABELS in current:
+            continue
+        if ALL_LABELS in labels:
+            current.clear()
+            current.add(ALL_LABELS)
+        else:
+            current.update(labels)
+
+
+def usage_to_dict(usage: dict) -> dict:
+    return {metric: sorted(labels) for metric, labels in usage.items()}
+
+
+class LabelUsage:
+    """Labels the dashboards of a run read, per metric. Metrics without a recorded usage need all of their
+    labels."""
+
+    def __init__(self):
+        self.usage = {}
+
+    def reset(self):
+        self.usage = {}
+
+    def add(self, usage):
+        merge_usage(self.usage, usage)
+
+    @property
+    def global_labels(self) -> set:
+        return set(self.usage.get(GLOBAL_LABELS_KEY, ())) - {ALL_LABELS}
+
+    def labels(self, metric):
+        """Labels metric needs, None when it needs all of them."""
+        labels = self.usage.get(metric)
+        if labels is None or ALL_LABELS in labels:
+            return None
+        return set(labels)
+
+    def to_dict(self) -> dict:
+        return usage_to_dict(self.usage)
+
+
+def _rule_entry(rule, labels, metrics, series_before, series_after) -> dict:
+    return {'rule': rule, 'labels': sorted(labels), 'metrics': sorted(metrics), 'series_before': int(series_before),
+            'series_after': int(series_after), 'reduction': int(series_before - series_after)}
+
+
+def build_relabel_rules(series_counts, label_names, kept_labels, label_drop_counts, labelkeep_counts=None) -> list:
+    """Relabel rules ranked by projected series reduction.
+
+    A label no shipped metric needs is dropped with labeldrop. Prometheus cannot scope labeldrop to some
+    metrics, so a label that other metrics still need is dropped from the metrics that do not need it with a
+    replace rule that empties it. labelkeep keeps the union of the needed labels, and is only suggested when the
+    label names of every counted metric are known.
+    """
+    needed_anywhere = set()
+    for labels in kept_labels.values():
+        needed_anywhere.update(labels)
+    complete = set(kept_labels) == set(series_counts)
+    rules = []
+    for label, counts in label_drop_counts.items():
+        metrics = sorted(counts)
+        before = sum(series_counts[metric] for metric in metrics)
+        after = sum(counts.values())
+        if complete and label not in needed_anywhere:
+            rule = {'action': RELABEL_ACTION_LABELDROP, 'regex': label}
+        else:
+            rule = {'source_labels': [METRIC_NAME_LABEL], 'regex': regex_compiler.compile_regex(metrics),
+                    'target_label': label, 'replacement': '', 'action': RELABEL_ACTION_REPLACE}
+        rules.append(_rule_entry(rule, [label], metrics, before, after))
+    if complete and labelkeep_counts:
+        keep = sorted(needed_anywhere | {METRIC_NAME_LABEL})
+        dropped = set()
+        for metric, names in label_names.items():
+            dropped.update(set(names) - set(keep))
+        rule = {'action': RELABEL_ACTION_LABELKEEP, 'regex': '|'.join(keep)}
+        rules.append(_rule_entry(rule, dropped, labelkeep_counts,
+                                 sum(series_counts[metric] for metric in labelkeep_counts),
+                                 sum(labelkeep_counts.values())))
+    rules = [entry for entry in rules if entry['reduction'] > 0]
+    return sorted(rules, key=lambda entry: entry['reduction'], reverse=True)
+
+
+def format_relabel_rules(relabel_rules) -> str:
+    """The rules as a metric_relabel_configs / write_relabel_configs yaml list, each preceded by its estimate."""
+    lines = []
+    for entry in relabel_rules:
+        lines.append(f'# {entry["series_before"]} -> {entry["series_after"]} series (-{entry["reduction"]}), '
+                     f'{entry["rule"]["action"]} {",".join(entry["labels"])} on {len(entry["metrics"])} metrics')
+        lines.append(yaml.safe_dump([entry['rule']], sort_keys=False, default_flow_style=False).rstrip())
+    return '\n'.join(lines)
+
+
+def save_relabel_rules(relabel_rules, path):
+    with open(path, 'w') as rules_file:
+        rules_file.write(format_relabel_rules(relabel_rules) + '\n')
+    logger.info(f'Relabel rules written to {path}')
@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+from array import array
+
+INDEX_FORMAT_VERSION = 1
+ID_TYPECODE = 'I'
+
+
+class _IdLists:
+    """Append-only lists of integer ids stored back to back in one array, with the offset of each list."""
+
+    def __init__(self):
+        self._ids = array(ID_TYPECODE)
+        self._offsets = array(ID_TYPECODE, [0])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, ids) -> int:
+        self._ids.extend(ids)
+        self._offsets.append(len(self._ids))
+        return len(self._offsets) - 2
+
+    def __getitem__(self, list_id):
+        return self._ids[self._offsets[list_id]:self._offsets[list_id + 1]]
+
+
+class MetricIndex:
+    """Inverted index between metrics and the dashboards/panels that use them.
+
+    Metric names are interned to integer ids. Each dashboard and panel keeps the ids of its metrics, and each metric
+    keeps the ascending ids of the dashboards and panels using it in an append-only array. Inserts are constant
+    time and memory grows with the number of metric uses, so "who uses metric X" or "what only dashboard Y uses" are
+    direct lookups. Dashboards extracted from several Grafana sources also keep a metric id set per source.
+    Dashboard and panel memberships are only kept when track_uses is set, as they are only needed to query or save
+    the index. Without them memory only grows with the number of distinct metrics and dashboards.
+    """
+
+    def __init__(self, track_uses=True):
+        self.track_uses = track_uses
+        self.metric_names = []
+        self.dashboard_names = []
+        self.dashboard_sources = []
+        self._panel_dashboards = array(ID_TYPECODE)
+        self._panel_titles = []
+        self._source_metrics = {}
+        self._metric_ids = {}
+        self._dashboard_ids = {}
+        self._dashboard_metrics = _IdLists()
+        self._panel_metrics = _IdLists()
+        self._metric_dashboards = []
+        self._metric_panels = []
+
+    def __len__(self):
+        return len(self.metric_names)
+
+    def __contains__(self, metric):
+        return metric in self._metric_ids
+
+    @property
+    def panels(self) -> list:
+        return list(zip(self._panel_dashboards, self._panel_titles))
+
+    def intern(self, metric) -> int:
+        metric_id = self._metric_ids.get(metric)
+        if metric_id is None:
+            metric_id = len(self.metric_names)
+            self._metric_ids[metric] = metric_id
+            self.metric_names.append(metric)
+            if self.track_uses:
+                self._metric_dashboards.append(array(ID_TYPECODE))
+                self._metric_panels.append(array(ID_TYPECODE))
+        return metric_id
+
+    def _intern_all(self, metrics) -> list:
+        return list(dict.fromkeys(self.intern(metric) for metric in metrics or []))
+
+    def add_dashboard(self, name, metrics, panels=None, source=None) -> int:
+        dashboard_id = len(self.dashboard_names)
+        self.dashboard_names.append(name)
+        self.dashboard_sources.append(source)
+        self._dashboard_ids.setdefault(name, []).append(dashboard_id)
+        metric_ids = self._intern_all(metrics)
+        if source is not None:
+            self._source_metrics.setdefault(source, set()).update(metric_ids)
+        if self.track_uses:
+            for metric_id in metric_ids:
+                self._metric_dashboards[metric_id].append(dashboard_id)
+            self._dashboard_metrics.append(metric_ids)
+            for panel in panels or []:
+                self._add_panel(dashboard_id, panel['title'], panel['metrics'])
+        return dashboard_id
+
+    def _add_panel(self, dashboard_id, title, metrics):
+        panel_id = len(self._panel_titles)
+        self._panel_dashboards.append(dashboard_id)
+        self._panel_titles.append(title)
+        metric_ids = self._intern_all(metrics)
+        for metric_id in metric_ids:
+            self._metric_panels[metric_id].append(panel_id)
+        self._panel_metrics.append(metric_ids)
+
+    def _names(self, metric_ids) -> list:
+        return sorted(self.metric_names[metric_id] for metric_id in metric_ids)
+
+    def metrics(self) -> list:
+        return sorted(self.metric_names)
+
+    def dashboard_metrics(self, dashboard_id) -> list:
+        return self._names(self._dashboard_metrics[dashboard_id])
+
+    def dashboards_using(self, metric) -> list:
+        """Dashboards that would break if metric was dropped."""
+        metric_id = self._metric_ids.get(metric)
+        if metric_id is None:
+            return []
+        return [self.dashboard_names[dashboard_id] for dashboard_id in self._metric_dashboards[metric_id]]
+
+    def sources_using(self, metric) -> list:
+        metric_id = self._metric_ids.get(metric)
+        if metric_id is None:
+            return []
+        return sorted(source for source, metric_ids in self._source_metrics.items() if metric_id in metric_ids)
+
+    def metric_sources(self) -> dict:
+        """Grafana sources of every metric, for indexes built from several sources."""
+        metric_sources = {}
+        for source in sorted(self._source_metrics):
+            for metric_id in self._source_metrics[source]:
+                metric_sources.setdefault(self.metric_names[metric_id], []).append(source)
+        return dict(sorted(metric_sources.items()))
+
+    def panels_using(self, metric) -> list:
+        metric_id = self._metric_ids.get(metric)
+        if metric_id is None:
+            return []
+        return [(self.dashboard_names[self._panel_dashboards[panel_id]], self._panel_titles[panel_id])
+                for panel_id in self._metric_panels[metric_id]]
+
+    def metrics_only_used_by(self, dashboard_name) -> list:
+        dashboard_ids = set(self._dashboard_ids.get(dashboard_name, []))
+        metric_ids = set()
+        for dashboard_id in dashboard_ids:
+            metric_ids.update(self._dashboard_metrics[dashboard_id])
+        return sorted(self.metric_names[metric_id] for metric_id in metric_ids
+                      if dashboard_ids.issuperset(self._metric_dashboards[metric_id]))
+
+    def to_dict(self) -> dict:
+        panels_by_dashboard = [[] for _ in self.dashboard_names]
+        for panel_id, (dashboard_id, title) in enumerate(zip(self._panel_dashboards, self._panel_titles)):
+            panels_by_dashboard[dashboard_id].append({'title': title, 'metrics': list(self._panel_metrics[panel_id])})
+        dashboards = [{'name': name, 'metrics': list(self._dashboard_metrics[dashboard_id]),
+                       'panels': panels_by_dashboard[dashboard_id]}
+                      for dashboard_id, name in enumerate(self.dashboard_names)]
+        for dashboard, source in zip(dashboards, self.dashboard_sources):
+            if source is not None:
+                dashboard['source'] = source
+        return {'version': INDEX_FORMAT_VERSION, 'metrics': self.metric_names, 'dashboards': dashboards}
+
+    @classmethod
+    def from_dict(cls, content):
+        index = cls()
+        names = content['metrics']
+        for dashboard in content['dashboards']:
+            panels = [{'title': panel['title'], 'metrics': [names[metric_id] for metric_id in panel['metrics']]}
+                      for panel in dashboard.get('panels', [])]
+            index.add_dashboard(dashboard['name'], [names[metric_id] for metric_id in dashboard['metrics']], panels,
+                                dashboard.get('source'))
+        return index
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self.to_dict(), index_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as index_file:
+            return cls.from_dict(json.load(index_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a metric index written by the dashboard metrics extractor')
+    parser.add_argument('index_path')
+    parser.add_argument('--dropping', metavar='METRIC', help='list the dashboards and panels that use METRIC')
+    parser.add_argument('--only-in', metavar='DASHBOARD', help='list the metrics used by DASHBOARD alone')
+    args = parser.parse_args()
+    index = MetricIndex.load(args.index_path)
+    if args.dropping:
+        print(f'Dashboards using {args.dropping}:')
+        print('\n'.join(index.dashboards_using(args.dropping)))
+        print(f'Panels using {args.dropping}:')
+        for dashboard, panel in index.panels_using(args.dropping):
+            print(f'{dashboard}: {panel}')
+        sources = index.sources_using(args.dropping)
+        if sources:
+            print(f'Grafana sources using {args.dropping}:')
+            print('\n'.join(sources))
+    if args.only_in:
+        print('\n'.join(index.metrics_only_used_by(args.only_in)))
+    if not args.dropping and not args.only_in:
+        print(f'{len(index)} metrics used by {len(index.dashboard_names)} dashboards')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,84 +1,126 @@
-import json
 import logging
-import os
 import re
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers.promql import PromQLLexer
+import threading
+import time
 import requests
 
+import grafana_search
+import label_usage
+import offline_ingest
+import promql_parser
+import recording_rules
+import regex_compiler
+import report_writer
+from dashboard_store import DashboardStore
+from expression_cache import ExpressionCache
+from http_client import ConcurrentFetcher
+from instrumentation import RUN_STATS
+from metric_index import MetricIndex
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-PROMQL_FUNCTIONS = ['sum', 'sumwithout', 'sumby', 'maxwithout', 'maxby', 'countwithout', 'countby']
-PROMQL_GROUPING_STATEMENTS = ['by(', 'on(', ',', 'group_right(', 'group_left(', 'sum_rate(']
 REGEX_FILTER = '[a-zA-Z_:][a-zA-Z0-9_:]*'
 SUPPORTED_REGIONS = ['us', 'eu', 'uk', 'nl', 'ca', 'au', 'wa']
 TOKEN_REGEX = '^[a-z 0-9]+-[a-z 0-9]+-[a-z 0-9]+-[a-z 0-9]+-[a-z 0-9]+$'
+EXPRESSION_KIND = 'expr'
+LABEL_VALUES_KIND = 'label_values'
+LABEL_VALUES_LABELS_KIND = 'label_values_labels'
+LABEL_VALUES_REGEX = r'label_values\s*\((.*)\)'
 
+EXPRESSION_CACHE = ExpressionCache()
+RECORDING_RULES = recording_rules.RuleGraph()
+LABEL_USAGE = label_usage.LabelUsage()
+# Parse time is summed per thread and recorded once per dashboard, keeping RUN_STATS' lock off the per expression path
+_PARSE_TIME = threading.local()
 
-def _find_grouping(query_string):
-    grouping_indices = []
-    for statement in PROMQL_GROUPING_STATEMENTS:
-        try:
-            indices = [i for i in range(len(query_string)) if query_string.startswith(statement, i)]
-            for idx in indices:
-                grouping_indices.append(idx + len(statement))
-        except ValueError:
-            logger.error(f'Error while group parsing, query string: {query_string}')
 
-    return grouping_indices
+def _analyze_expression(expr):
+    started_at = time.perf_counter()
+    try:
+        return promql_parser.analyze(expr)
+    except promql_parser.PromQLSyntaxError as e:
+        logger.error(f'Cannot parse expression: "{expr}", skipping, error: {e}')
+        return promql_parser.ExpressionAnalysis([], [], [], [])
+    finally:
+        _PARSE_TIME.seconds = getattr(_PARSE_TIME, 'seconds', 0.0) + time.perf_counter() - started_at
+        _PARSE_TIME.calls = getattr(_PARSE_TIME, 'calls', 0) + 1
+
+
+def _record_parse_time():
+    calls = getattr(_PARSE_TIME, 'calls', 0)
+    if calls:
+        RUN_STATS.record_stage('parse expressions', _PARSE_TIME.seconds, calls)
+        _PARSE_TIME.seconds = 0.0
+        _PARSE_TIME.calls = 0
 
 
 def _find_rules(expr):
-    rules = []
-    names = re.findall(REGEX_FILTER, expr)
-    for name in names:
-        if ':' in name:
-            rules.append(name)
-    return rules
+    return _analyze_expression(expr).rules
 
 
 def _find_metrics_names(expr):
-    names = []
-    rules = _find_rules(expr)
-    grouping = []
-    splited_query = highlight(expr, PromQLLexer(), HtmlFormatter()).split('"nv">')
-    for ex in splited_query:
-        ex = ex.split('<', 1)
-        if ex[0] and ex[0] not in PROMQL_FUNCTIONS:
-            names.append(ex[0])
-    names = list(dict.fromkeys(names))
-    grouping_indices = _find_grouping(expr)
-    if grouping_indices:
-        for name in names:
-            indices = [i for i in range(len(expr)) if expr.startswith(name, i)]
-            for idx in indices:
-                for g_idx in grouping_indices:
-                    if idx == g_idx:
-                        grouping.append(name)
-    return list(set(names) - set(grouping)), rules
-
-
-def _add_metrics(panel, index, dataset):
+    analysis = _analyze_expression(expr)
+    return analysis.metrics, analysis.rules
+
+
+def _expression_metrics(expr):
+    """Metrics and recording rules an expression reads, with the labels it reads of each. Rules are expanded to
+    raw metrics when dashboards are aggregated."""
+    analysis = _analyze_expression(expr)
+    return list(analysis.rules) + [metric for metric in analysis.metrics if metric != 'le'], analysis.label_usage
+
+
+def _add_metrics(panel, metrics, panels=None, labels=None):
     targets = panel.get('targets')
-    if targets is not None and dataset[index].get('metrics') is not None:
+    if targets is not None and metrics is not None:
+        panel_metrics = []
         for target in targets:
             if target.get('expr') is not None:
-                metrics, rules = _find_metrics_names(target['expr'].replace(' ', ''))
-                dataset[index]['metrics'].extend(rules)
-                for metric in metrics:
-                    name_in_rules = False
-                    for rule in rules:
-                        if metric in rule:
-                            name_in_rules = True
-                    if metric == 'le' or name_in_rules:
-                        pass
-                    else:
-                        dataset[index]['metrics'].append(metric)
-
-
-def _extract_metrics(dashboard):
+                names, expression_labels = EXPRESSION_CACHE.get_or_compute(EXPRESSION_KIND, target['expr'],
+                                                                           _expression_metrics)
+                panel_metrics.extend(names)
+                if labels is not None:
+                    label_usage.merge_usage(labels, expression_labels)
+        metrics.extend(panel_metrics)
+        if panels is not None and panel_metrics:
+            panels.append({'title': panel.get('title') or '', 'metrics': sorted(set(panel_metrics))})
+
+
+def _label_values_metric(query):
+    """Metric a label_values(metric, label) template query reads, none for label_values(label), which reads all
+    metrics, or None when the query cannot be parsed."""
+    match_obj = re.search(LABEL_VALUES_REGEX, query, re.DOTALL)
+    if match_obj is not None and not match_obj.group(1).rpartition(',')[0].strip():
+        return []
+    names = re.findall(REGEX_FILTER, query)
+    try:
+        label_values_index = names.index('label_values')
+        return [names[label_values_index + 1]]
+    except (IndexError, ValueError):
+        return None
+
+
+def _label_values_labels(query):
+    """Labels a label_values(metric, label) template query reads of its metric, or label_values(label) reads of all
+    metrics."""
+    match_obj = re.search(LABEL_VALUES_REGEX, query, re.DOTALL)
+    if match_obj is None:
+        return {}
+    selector, _, label = match_obj.group(1).rpartition(',')
+    label = label.strip().strip('"\'')
+    if not selector.strip():
+        return {label_usage.GLOBAL_LABELS_KEY: [label]}
+    try:
+        analysis = promql_parser.analyze(selector)
+    except promql_parser.PromQLSyntaxError:
+        return {}
+    return {metric: sorted({label} | {matcher.label for matcher in analysis.matchers if matcher.metric == metric}
+                           - {promql_parser.METRIC_NAME_LABEL})
+            for metric in analysis.metrics + analysis.rules}
+
+
+def _extract_metrics(dashboard, labels=None):
     dash_templating = dashboard.get('templating')
     if dash_templating is None:
         logger.error(f'No templating for dashboard: {dashboard}, skipping')
@@ -87,19 +129,64 @@ def _extract_metrics(dashboard):
     metrics = []
     for var in templating:
         if var['type'] == 'query':
-            try:
-                names = re.findall(REGEX_FILTER, str(var['query']))
-                label_values_index = names.index('label_values')
-                metrics.append(names[label_values_index + 1])
-            except (IndexError, ValueError):
+            names = EXPRESSION_CACHE.get_or_compute(LABEL_VALUES_KIND, str(var['query']), _label_values_metric)
+            if names is None:
                 dashboard_name = dashboard['title']
                 logger.error(
                     f'Cannot parse: "{var["query"]}" in {dashboard_name}, dashboard might not be '
                     f'supported, skipping')
                 break
+            metrics.extend(names)
+            if labels is not None:
+                label_usage.merge_usage(labels, EXPRESSION_CACHE.get_or_compute(
+                    LABEL_VALUES_LABELS_KIND, str(var['query']), _label_values_labels))
     return metrics
 
 
+def _load_expression_cache(config):
+    cache_config = config.get('expression_cache') or {}
+    if cache_config.get('max_size'):
+        EXPRESSION_CACHE.max_size = int(cache_config['max_size'])
+    if cache_config.get('max_bytes'):
+        EXPRESSION_CACHE.max_bytes = int(cache_config['max_bytes'])
+    EXPRESSION_CACHE.load(cache_config.get('path'))
+
+
+def _save_expression_cache(config):
+    cache_config = config.get('expression_cache') or {}
+    _record_expression_cache_stats()
+    EXPRESSION_CACHE.save(cache_config.get('path'))
+
+
+def _record_expression_cache_stats():
+    stats = EXPRESSION_CACHE.stats()
+    logger.info(f'Expression cache stats: {stats}')
+    RUN_STATS.record_cache('expressions', stats['hits'], stats['misses'])
+    if len(RECORDING_RULES):
+        RECORDING_RULES.record_stats()
+
+
+def load_recording_rules(config):
+    recording_rules.load_from_config(RECORDING_RULES, config)
+
+
+def _expand_recording_rules(dashboard_metrics):
+    """Replaces the recording rules a dashboard and its panels reference with the raw metrics they are computed
+    from, and the labels read of a rule with the labels the rule reads of those metrics."""
+    if not len(RECORDING_RULES):
+        return
+    dashboard_metrics['metrics'] = RECORDING_RULES.expand(dashboard_metrics['metrics'])
+    dashboard_metrics['panels'] = [dict(panel, metrics=RECORDING_RULES.expand(panel['metrics']))
+                                   for panel in dashboard_metrics.get('panels') or []]
+    labels = {}
+    for name, name_labels in (dashboard_metrics.get('labels') or {}).items():
+        if name in RECORDING_RULES:
+            label_usage.merge_usage(labels, RECORDING_RULES.resolve_labels(name))
+        else:
+            label_usage.merge_usage(labels, {name: name_labels})
+    dashboard_metrics['labels'] = label_usage.usage_to_dict(labels)
+
+
 def check_metric_for_telegraf_input(metric, telegraf_mapping):
     input_end_index = 0
     try:
@@ -115,35 +202,14 @@ def check_metric_for_telegraf_input(metric, telegraf_mapping):
         telegraf_mapping[input_name].add(input_value)
 
 
-def format_telegraf_fieldpass(field_list):
-    fieldpass_pattern = '['
-    telegraf_metric = ''
-    for i, field in enumerate(field_list):
-        fieldpass_pattern = f'{fieldpass_pattern}"{field}"' if i == 0 else f'{fieldpass_pattern},"{field}"'
-    fieldpass_pattern += ']'
-    return fieldpass_pattern
-
-
-def print_telegraf_regex(telegraf_mapping):
-    pattern = ''
-    print('Telegraf filter by input:')
-    for key, value in telegraf_mapping.items():
-        pattern = format_telegraf_fieldpass(value)
-        print(f'{key} fieldpass regex: {pattern}')
-
-
-def _to_regex(list):
-    pattern = ''
+def _regex_outputs(metrics, regex_max_length=None):
     telegraf_mapping = dict()
-    for i, metric in enumerate(list):
-        pattern = f'{pattern}{metric}' if i == 0 else f'{pattern}|{metric}'
+    for metric in metrics:
         check_metric_for_telegraf_input(metric, telegraf_mapping)
-    print(f'As Prometheus regex: \n{pattern}')
-    print('------------')
-    print_telegraf_regex(telegraf_mapping)
+    return regex_compiler.compile_regex_chunks(metrics, regex_max_length), telegraf_mapping
 
 
-def _add_panels_metrics(dashboard, i, dataset):
+def _add_panels_metrics(dashboard, metrics, panels_metrics=None, labels=None):
     try:
         panels = dashboard.get('rows')
         if not panels:
@@ -152,104 +218,191 @@ def _add_panels_metrics(dashboard, i, dataset):
             if panel['type'] == 'row':
                 if panel.get('panels') is not None:
                     for row_panel in panel['panels']:
-                        _add_metrics(row_panel, i, dataset)
+                        _add_metrics(row_panel, metrics, panels_metrics, labels)
             elif panel['type'] == 'text':
                 pass
             else:
-                _add_metrics(panel, i, dataset)
+                _add_metrics(panel, metrics, panels_metrics, labels)
     except KeyError:
         dashboard_title = dashboard['title']
         logger.error(f'Could not parse dashboard panels, skipping panels for dashboard: {dashboard_title}')
 
 
-def _extract_dashboards_metrics(base_url, headers, response):
-    uid_list = _extract_uid_from_response(response)
-    dataset = []
-    all_metrics = []
-    dashboards = _init_dashboard_list(base_url, uid_list, headers)
-    for i, dashboard in enumerate(dashboards):
-        metrics = _extract_metrics(dashboard)
-        dataset.append({
-            'name': dashboard['title'],
-            'metrics': metrics
-        })
-        _add_panels_metrics(dashboard, i, dataset)
-    return _count_total_metrics(all_metrics, dataset)
+def _extract_dashboard_metrics(dashboard) -> dict:
+    started_at = time.perf_counter()
+    labels = {}
+    panels = []
+    try:
+        metrics = _extract_metrics(dashboard, labels)
+        _add_panels_metrics(dashboard, metrics, panels, labels)
+    finally:
+        RUN_STATS.record_stage('extract dashboards', time.perf_counter() - started_at)
+        _record_parse_time()
+    return {
+        'name': dashboard['title'],
+        'metrics': metrics,
+        'panels': panels,
+        'labels': label_usage.usage_to_dict(labels)
+    }
+
+
+def _stream_dashboards_metrics(dashboards):
+    """Reduces each dashboard to its metrics as it arrives, so only one dashboard's json is held at a time."""
+    for dashboard in dashboards:
+        yield _extract_dashboard_metrics(dashboard)
+
+
+def _stream_stored_dashboards_metrics(base_url, fetcher, uid_list, unchanged_uids, changed_uids, store):
+    for uid in uid_list:
+        if uid in unchanged_uids:
+            entry = store.get(uid)
+            yield {'name': entry['title'], 'metrics': entry['metrics'], 'panels': entry.get('panels', []),
+                   'labels': entry.get('labels', {})}
+    for dashboard in _init_dashboard_list(base_url, changed_uids, fetcher):
+        dashboard_metrics = _extract_dashboard_metrics(dashboard)
+        store.put(dashboard.get('uid'), dashboard.get('version'), dashboard['title'], dashboard_metrics['metrics'],
+                  dashboard_metrics['panels'], dashboard_metrics['labels'])
+        yield dashboard_metrics
+    store.save()
+
+
+def _extract_dashboards_metrics(base_url, fetcher, hits, store=None, regex_max_length=None, index=None,
+                                report=None, prune_store=True):
+    dataset = _stream_hits_metrics(base_url, fetcher, hits, store, prune_store)
+    return _count_total_metrics([], dataset, regex_max_length, index, report)
+
+
+def _stream_hits_metrics(base_url, fetcher, hits, store=None, prune_store=True, source=None):
+    """Metrics of the searched dashboards, served from the store when their version is unchanged."""
+    uid_list = [hit.get('uid') for hit in hits]
+    store = store if store is not None else DashboardStore()
+    if prune_store:
+        store.retain(uid_list)
+    with RUN_STATS.stage('dashboard versions'):
+        versions = _get_dashboard_versions(base_url, hits, store, fetcher)
+    changed_uids = [uid for uid in uid_list if not store.is_current(uid, versions.get(uid))]
+    unchanged_uids = set(uid_list) - set(changed_uids)
+    RUN_STATS.record_cache('dashboard store' if source is None else f'dashboard store {source}', len(unchanged_uids),
+                           len(changed_uids))
+    logger.info(f'{base_url}: {len(uid_list) - len(changed_uids)} dashboards are unchanged since the last run, '
+                f'fetching {len(changed_uids)} new or changed dashboards')
+    return _stream_stored_dashboards_metrics(base_url, fetcher, uid_list, unchanged_uids, changed_uids, store)
+
+
+def _parse_version_response(version_json):
+    return (grafana_search.latest_version(version_json) or {}).get('version')
+
+
+def _get_dashboard_versions(base_url, hits, store, fetcher) -> dict:
+    versions = {}
+    unknown_uids = []
+    for hit in hits:
+        uid = hit.get('uid')
+        if hit.get('version') is not None:
+            versions[uid] = hit['version']
+        elif store.get(uid) is not None:
+            unknown_uids.append(uid)
+    if not unknown_uids:
+        return versions
+    logger.info(f'Checking the latest version of {len(unknown_uids)} known dashboards')
+    urls = {f'{base_url}/api/dashboards/uid/{uid}/versions?limit=1': uid for uid in unknown_uids}
+    for url, response, error in fetcher.fetch_all(urls):
+        if error is not None or response.status_code != 200:
+            continue
+        try:
+            versions[urls[url]] = _parse_version_response(response.json())
+        except (ValueError, AttributeError):
+            logger.error(f'Could not parse the version list of dashboard with uid: {urls[url]}')
+    return versions
 
 
-def _init_dashboard_list(base_url, uid_list, headers=None):
-    dashboards = []
+def _init_dashboard_list(base_url, uid_list, fetcher):
     logger.info('Initializing dashboards list from uids')
-    for i, uid in enumerate(uid_list):
-        response = requests.get(f'{base_url}/api/dashboards/uid/{uid}', headers=headers)
+    return RUN_STATS.timed_iter('fetch dashboards', _fetch_dashboards(base_url, uid_list, fetcher))
+
+
+def _fetch_dashboards(base_url, uid_list, fetcher):
+    urls = {f'{base_url}/api/dashboards/uid/{uid}': uid for uid in uid_list}
+    for url, response, error in fetcher.fetch_all(urls):
+        uid = urls[url]
+        if error is not None:
+            logger.error(f'Encountered in error while fetching dashboard with uid: {uid}, message: {error}')
+            continue
         if response.status_code != 200:
             response_message = response.text
             logger.error(f'Encountered in error while fetching dashboard with uid: {uid}, message: {response_message}')
+            continue
         dashboard = response.json()
         try:
-            del dashboard['meta']
-            dashboards.append(dashboard['dashboard'])
+            meta = dashboard.pop('meta')
+            dashboard['dashboard'].setdefault('uid', uid)
+            dashboard['dashboard'].setdefault('version', meta.get('version'))
+            yield dashboard['dashboard']
         except KeyError:
-            dash_title = dashboard['dashboard']['title']
-            logger.error(f'Error while removing meta from dashboard: {dash_title}')
-    return dashboards
+            logger.error(f'Error while removing meta from dashboard with uid: {uid}')
 
 
-def _count_total_metrics(all_metrics, dataset) -> list:
+def _count_total_metrics(all_metrics, dataset, regex_max_length=None, index=None, report=None) -> list:
+    index = index if index is not None else MetricIndex(track_uses=False)
+    report = report if report is not None else report_writer.TextReportWriter()
+    for metric in all_metrics:
+        index.intern(metric)
+    LABEL_USAGE.reset()
+    # dataset is lazy: fetching and extraction are timed by their producers, this only times the aggregation
+    aggregate_seconds = 0.0
+    dashboards = 0
     for s in dataset:
         if s['metrics'] is None:
             continue
-        s['metrics'] = sorted(list(dict.fromkeys(s['metrics'])))
+        started_at = time.perf_counter()
+        _expand_recording_rules(s)
+        LABEL_USAGE.add(s.get('labels'))
+        index.add_dashboard(s['name'], s['metrics'], s.get('panels'), s.get('source'))
+        s['metrics'] = sorted(set(s['metrics']))
         if len(s['metrics']) > 0:
-            print('------------')
-            print('Total number of metrics in {} : {}'.format(s['name'], len(s['metrics'])))
-            print('------------')
-            for metric in s['metrics']:
-                print(metric)
-            _to_regex(s['metrics'])
-            all_metrics.extend(s['metrics'])
-    all_metrics = sorted(list(set(all_metrics)))
-    print('------------')
-    print(f'Total number of distinct metrics: {len(all_metrics)}')
-    print('------------')
-    for metric in all_metrics:
-        print(metric)
-    _to_regex(all_metrics)
+            report.write_dashboard(s['name'], s['metrics'], *_regex_outputs(s['metrics'], regex_max_length))
+        aggregate_seconds += time.perf_counter() - started_at
+        dashboards += 1
+    RUN_STATS.record_stage('aggregate dashboards', aggregate_seconds, dashboards)
+    all_metrics = index.metrics()
+    report.write_summary(all_metrics, *_regex_outputs(all_metrics, regex_max_length))
+    report.flush()
     return all_metrics
 
 
-def _extract_uid_from_response(response):
-    logger.info('Extracting dashboards uids')
-    if response.status_code != 200:
-        raise requests.ConnectionError(response.text)
-    response_json = json.loads(response.content)
-    uid_list = []
-    for dashboard in response_json:
-        if dashboard['type'] == 'dash-db':
-            uid_list.append(dashboard.get('uid'))
-    return uid_list
+def grafana_headers(grafana_config) -> dict:
+    return {'Authorization': 'Bearer ' + grafana_config['token'],
+            'Content-Type': 'application/json', 'Accept': 'application/json'}
 
 
-def get_total_metrics_count(config):
+def extract_grafana_metrics(config, fetcher, store, report=None) -> list:
+    """Searches, fetches and aggregates the dashboards of config['grafana'] with an open fetcher and store."""
+    base_url = config['grafana']['endpoint']
+    search_config = config['grafana'].get('search') or {}
+    with RUN_STATS.stage('grafana search'):
+        hits = grafana_search.search_dashboards(base_url, fetcher, search_config)
+    index = MetricIndex(track_uses=bool(config.get('metric_index_path')))
+    try:
+        return _extract_dashboards_metrics(base_url, fetcher, hits, store, config.get('regex_max_length'), index,
+                                           report, prune_store=not grafana_search.is_filtered(search_config))
+    finally:
+        _save_expression_cache(config)
+        if config.get('metric_index_path'):
+            index.save(config['metric_index_path'])
+
+
+def get_total_metrics_count(config, report=None):
     try:
         grafana_config = config['grafana']
         if grafana_config.get('endpoint') is not None:
             try:
                 base_url = grafana_config.get('endpoint')
                 logger.info(f"Grafana endpoint base url: {base_url}")
-                headers = {'Authorization': 'Bearer ' + grafana_config['token'],
-                           'Content-Type': 'application/json', 'Accept': 'application/json'}
-                search_url=base_url + '/api/search'
-                logger.info(f"Grafana endpoint search url: {search_url}")
-                response = requests.get(
-                    search_url
-                    , headers=headers)
-                if response.status_code != 200:
-                    logger.error(
-                        "Received status code: {}, cannot complete dashboards fetch".format(response.status_code))
-                    return
-                return _extract_dashboards_metrics(base_url, headers, response)
-            except requests.HTTPError:
+                _load_expression_cache(config)
+                with ConcurrentFetcher.from_config(grafana_config, grafana_headers(grafana_config)) as fetcher:
+                    store = DashboardStore.from_config(config, base_url)
+                    return extract_grafana_metrics(config, fetcher, store, report)
+            except (requests.HTTPError, requests.ConnectionError):
                 logger.error(
                     "Cannot get a response from grafana api, please check the input")
         else:
@@ -258,19 +411,17 @@ def get_total_metrics_count(config):
         logger.error('Invalid input for grafana api, skipping dashboard metrics count')
 
 
-def get_dashboards_from_folder():
-    dashboards = []
-    filenames = os.listdir("dashboards")
-    for filename in filenames:
-        dashboard = json.load(open("dashboards/" + filename))
-        dashboards.append(dashboard)
-    return dashboards
+def get_dashboards_from_folder(path=offline_ingest.DEFAULT_DASHBOARDS_PATH):
+    for file_path in offline_ingest.iter_dashboard_files(path):
+        yield from offline_ingest.read_dashboards(file_path)
 
 
 def logzio_metrics_extractor():
     choice = input("select:\n1. load data from the dashboards folder\n2. load data using api token\n")
     if int(choice) == 1:
-        dashboards = get_dashboards_from_folder()
+        path = input(f"Enter the dashboards folder path, or press enter to use the "
+                     f"'{offline_ingest.DEFAULT_DASHBOARDS_PATH}' folder:")
+        return handle_dashboards_folder(path or offline_ingest.DEFAULT_DASHBOARDS_PATH)
     elif int(choice) == 2:
         dashboards = _get_dashboards_logzio_api()
     else:
@@ -279,39 +430,41 @@ def logzio_metrics_extractor():
     handle_dashboards(dashboards)
 
 
-def handle_dashboards(dashboards):
-    dataset = []
+def logzio_api_metrics(logzio_config, report=None):
+    return handle_dashboards(_get_dashboards_logzio_api(logzio_config.get('region'), logzio_config.get('token')),
+                             report)
+
+
+def handle_dashboards(dashboards, report=None):
     if dashboards is not None:
-        for i, dashboard in enumerate(dashboards):
-            var_metrics = _extract_metrics(dashboard)
-            dataset.append({
-                'name': dashboard['title'],
-                'metrics': var_metrics
-            })
-            try:
-                for panel in dashboard['panels']:
-                    if panel['type'] == 'row':
-                        if panel.get('panels') is not None:
-                            for row_panel in panel['panels']:
-                                _add_metrics(row_panel, i, dataset)
-                    elif panel['type'] == 'text':
-                        pass
-                    else:
-                        _add_metrics(panel, i, dataset)
-            except KeyError:
-                dashboard_name = dashboard['title']
-                logger.error(f'Error while parsing the dashboard panels for {dashboard_name}')
-        all_metrics = []
-        _count_total_metrics(all_metrics, dataset)
+        all_metrics = _count_total_metrics([], _stream_dashboards_metrics(dashboards), report=report)
+        _record_expression_cache_stats()
+        return all_metrics
+
 
+def _drain_worker_stats() -> dict:
+    """Stage timings and expression cache lookups of a folder worker process since its last file."""
+    return {'stages': RUN_STATS.drain_stages(), 'expression_cache': EXPRESSION_CACHE.drain_counts()}
 
-def _get_dashboards_logzio_api():
-    region = input("Enter logzio region:")
-    api_token = input("Enter logzio api token:")
 
+def _merge_worker_stats(stats):
+    RUN_STATS.merge_stages(stats['stages'])
+    EXPRESSION_CACHE.add_counts(**stats['expression_cache'])
+
+
+def handle_dashboards_folder(path=offline_ingest.DEFAULT_DASHBOARDS_PATH, workers=None, report=None):
+    dataset = offline_ingest.stream_folder_metrics(path, _extract_dashboard_metrics, workers, _drain_worker_stats,
+                                                   _merge_worker_stats)
+    all_metrics = _count_total_metrics([], dataset, report=report)
+    _record_expression_cache_stats()
+    return all_metrics
+
+
+def logzio_grafana_source(region, api_token) -> (str, dict):
+    """Validates a Logz.io region and API token, and returns the Grafana API base url and headers for them."""
     if region not in SUPPORTED_REGIONS:
         raise ValueError('region code is not supported: {}'.format(region))
-    match_obj = re.search(TOKEN_REGEX, api_token)
+    match_obj = re.search(TOKEN_REGEX, api_token or '')
     if match_obj is None or match_obj.group() is None:
         raise ValueError("API token is invalid: {}".format(api_token))
     LOGZIO_API_HEADERS = {
@@ -320,13 +473,23 @@ def _get_dashboards_logzio_api():
         'Cache-Control': 'no-cache',
         'User-Agent': None
     }
-    base_url = 'https://api.logz.io/v1/grafana' if region == 'us' else f'https://api-{region}.logz.io/v1/grafana/'
-    all_dashboards = requests.get(f'{base_url}/api/search', headers=LOGZIO_API_HEADERS)
-    dashboard_list = None
-    try:
-        uids = _extract_uid_from_response(all_dashboards)
-        dashboard_list = _init_dashboard_list(base_url, uids, LOGZIO_API_HEADERS)
-    except requests.ConnectionError as e:
-        logger.error(f"Encountered an error: {str(e)}")
-    # init list
-    return dashboard_list
+    base_url = 'https://api.logz.io/v1/grafana' if region == 'us' else f'https://api-{region}.logz.io/v1/grafana'
+    return base_url, LOGZIO_API_HEADERS
+
+
+def _get_dashboards_logzio_api(region=None, api_token=None):
+    region = region or input("Enter logzio region:")
+    api_token = api_token or input("Enter logzio api token:")
+    base_url, headers = logzio_grafana_source(region, api_token)
+    return _stream_logzio_dashboards(base_url, headers)
+
+
+def _stream_logzio_dashboards(base_url, headers):
+    """Searches and fetches the dashboards of a Logz.io account, closing the fetcher once they are consumed."""
+    with ConcurrentFetcher(headers=headers) as fetcher:
+        try:
+            uids = [hit.get('uid') for hit in grafana_search.search_dashboards(base_url, fetcher)]
+        except requests.ConnectionError as e:
+            logger.error(f"Encountered an error: {str(e)}")
+            return
+        yield from _init_dashboard_list(base_url, uids, fetcher)
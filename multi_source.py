@@ -0,0 +1,187 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+
+import grafana_search
+import metrics_dashboard_extractor
+import timeseries_extractor
+from dashboard_store import DashboardStore
+from http_client import ConcurrentFetcher
+from instrumentation import RUN_STATS
+from metric_index import MetricIndex
+
+logger = logging.getLogger()
+
+DEFAULT_SOURCES_CONCURRENCY = 4
+# Dashboards buffered between the source threads and the merge, bounds memory when sources outpace the report
+DASHBOARD_QUEUE_SIZE = 256
+QUEUE_PUT_TIMEOUT_SECONDS = 0.1
+SOURCE_NAME_SEPARATOR = '/'
+_SOURCE_DONE = object()
+
+
+def _as_list(section) -> list:
+    if not section:
+        return []
+    return list(section) if isinstance(section, list) else [section]
+
+
+def is_multi_source(config: dict) -> bool:
+    return isinstance(config.get('grafana'), list) or isinstance(config.get('prometheus'), list)
+
+
+def _unique_names(items, kind):
+    names = [item['name'] for item in items]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'{kind} names must be unique, found duplicates: {duplicates}. Set a name for each entry')
+
+
+def grafana_sources(config: dict) -> list:
+    """Grafana sources of config['grafana'], a single block or a list. Each source has an endpoint and token, or a
+    logzio_region and Logz.io API token, plus its own concurrency and requests_per_second limits."""
+    sources = []
+    for source_config in _as_list(config.get('grafana')):
+        if source_config.get('logzio_region'):
+            endpoint, headers = metrics_dashboard_extractor.logzio_grafana_source(source_config['logzio_region'],
+                                                                                  source_config.get('token'))
+            default_name = f'logzio-{source_config["logzio_region"]}'
+        else:
+            endpoint = source_config['endpoint']
+            headers = metrics_dashboard_extractor.grafana_headers(source_config)
+            default_name = urlparse(endpoint).netloc or endpoint
+        sources.append(dict(source_config, name=str(source_config.get('name') or default_name), endpoint=endpoint,
+                            headers=headers))
+    _unique_names(sources, 'Grafana source')
+    return sources
+
+
+def prometheus_targets(config: dict) -> list:
+    """Prometheus targets of config['prometheus'], a single block or a list, each with its own query limits."""
+    targets = [dict(target_config, name=str(target_config.get('name') or urlparse(target_config['endpoint']).netloc
+                                            or target_config['endpoint']))
+               for target_config in _as_list(config.get('prometheus')) if target_config.get('endpoint')]
+    _unique_names(targets, 'Prometheus target')
+    return targets
+
+
+def _put(dashboards_queue, item, stop):
+    while not stop.is_set():
+        try:
+            dashboards_queue.put(item, timeout=QUEUE_PUT_TIMEOUT_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _extract_source(config, source, dashboards_queue, stop):
+    """Runs in a source thread: searches and streams one source's dashboards to the merge, until the merge stops.
+
+    Closing the dashboards stream on stop cancels the source's fetches that have not started yet.
+    """
+    try:
+        if stop.is_set():
+            return
+        with ConcurrentFetcher.from_config(source, source['headers']) as fetcher:
+            search_config = source.get('search') or {}
+            hits = grafana_search.search_dashboards(source['endpoint'], fetcher, search_config)
+            if stop.is_set():
+                return
+            store = DashboardStore.from_config(config, source['name'])
+            logger.info(f'Grafana source {source["name"]}: found {len(hits)} dashboards')
+            for dashboard in metrics_dashboard_extractor._stream_hits_metrics(
+                    source['endpoint'], fetcher, hits, store, not grafana_search.is_filtered(search_config),
+                    source['name']):
+                dashboard['name'] = f'{source["name"]}{SOURCE_NAME_SEPARATOR}{dashboard["name"]}'
+                dashboard['source'] = source['name']
+                if not _put(dashboards_queue, dashboard, stop):
+                    return
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logger.error(f'Could not extract the dashboards of Grafana source {source["name"]}, skipping it. error: {e}')
+    finally:
+        _put(dashboards_queue, _SOURCE_DONE, stop)
+
+
+def _stream_sources_metrics(config, sources):
+    """Merges the dashboards of all sources in arrival order. Sources are extracted concurrently, each with its own
+    fetcher, so a slow or rate limited source does not hold back the others."""
+    dashboards_queue = queue.Queue(maxsize=DASHBOARD_QUEUE_SIZE)
+    stop = threading.Event()
+    concurrency = min(len(sources), int(config.get('sources_concurrency') or DEFAULT_SOURCES_CONCURRENCY))
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        try:
+            for source in sources:
+                futures.append(executor.submit(_extract_source, config, source, dashboards_queue, stop))
+            remaining = len(sources)
+            while remaining:
+                dashboard = dashboards_queue.get()
+                if dashboard is _SOURCE_DONE:
+                    remaining -= 1
+                    continue
+                yield dashboard
+        finally:
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+
+def extract_sources_metrics(config: dict, sources, report=None) -> list:
+    """Merged, deduplicated metrics of all Grafana sources; the report also lists the sources of each metric."""
+    index = MetricIndex(track_uses=bool(config.get('metric_index_path')))
+    metrics_dashboard_extractor._load_expression_cache(config)
+    try:
+        with RUN_STATS.stage('grafana sources'):
+            all_metrics = metrics_dashboard_extractor._count_total_metrics(
+                [], _stream_sources_metrics(config, sources), config.get('regex_max_length'), index, report)
+        if report is not None:
+            report.write_sources(index.metric_sources())
+        return all_metrics
+    finally:
+        metrics_dashboard_extractor._save_expression_cache(config)
+        if config.get('metric_index_path'):
+            index.save(config['metric_index_path'])
+
+
+def _count_target_timeseries(target, metrics, metrics_label_usage=None):
+    """Runs in a target thread: counts the target's time series, and estimates its label savings when enabled."""
+    timeseries_count = timeseries_extractor.count_prometheus_timeseries(target, metrics, target['name'])
+    label_savings = None
+    if metrics_label_usage is not None and timeseries_extractor.label_savings_config(target) is not None:
+        label_savings = timeseries_extractor.estimate_label_savings(target, timeseries_count[3],
+                                                                    metrics_label_usage)
+    return timeseries_count, label_savings
+
+
+def count_targets_timeseries(targets, metrics, report=None, metrics_label_usage=None):
+    """Counts the time series of the combined metric set on every target concurrently, each target with its own
+    query scheduler, and reports each target as it finishes."""
+    if not targets:
+        return
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {executor.submit(_count_target_timeseries, target, metrics, metrics_label_usage): target
+                   for target in targets}
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                timeseries_count, label_savings = future.result()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logger.error(f'Could not count the time series of Prometheus target {target["name"]}. error: {e}')
+                continue
+            timeseries_extractor.report_timeseries_count(timeseries_count, report, target['name'])
+            if label_savings is not None:
+                timeseries_extractor.report_label_savings(label_savings, target, report, target['name'])
+
+
+def run(config: dict, report=None) -> list:
+    """Extracts every configured Grafana source and counts the combined metrics on every Prometheus target."""
+    sources = grafana_sources(config)
+    logger.info(f'Extracting {len(sources)} Grafana sources: {", ".join(source["name"] for source in sources)}')
+    metrics = extract_sources_metrics(config, sources, report) if sources else []
+    count_targets_timeseries(prometheus_targets(config), metrics, report, metrics_dashboard_extractor.LABEL_USAGE)
+    return metrics
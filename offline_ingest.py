@@ -0,0 +1,107 @@
+import gzip
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+logger = logging.getLogger()
+
+DEFAULT_DASHBOARDS_PATH = 'dashboards'
+DASHBOARD_FILE_EXTENSIONS = ('.json', '.json.gz', '.ndjson', '.ndjson.gz', '.jsonl', '.jsonl.gz')
+FILES_PER_TASK = 16
+
+
+def iter_dashboard_files(path):
+    for root, directories, filenames in os.walk(path):
+        directories.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(DASHBOARD_FILE_EXTENSIONS):
+                yield os.path.join(root, filename)
+
+
+def _open_dashboard_file(file_path):
+    if file_path.lower().endswith('.gz'):
+        return gzip.open(file_path, 'rt', encoding='utf-8')
+    return open(file_path, 'r', encoding='utf-8')
+
+
+def _unwrap_dashboards(content):
+    if isinstance(content, list):
+        for item in content:
+            yield from _unwrap_dashboards(item)
+    elif isinstance(content, dict):
+        # Exports taken from /api/dashboards/uid/<uid> wrap the dashboard model together with its meta
+        yield content['dashboard'] if isinstance(content.get('dashboard'), dict) else content
+
+
+def read_dashboards(file_path):
+    """Yields the dashboards of a json, gzipped json or newline delimited json export file."""
+    with _open_dashboard_file(file_path) as dashboard_file:
+        text = dashboard_file.read()
+    try:
+        content = json.loads(text)
+    except json.JSONDecodeError:
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                yield from _unwrap_dashboards(json.loads(line))
+            except json.JSONDecodeError:
+                logger.error(f'Could not parse line {line_number} of {file_path}, skipping it')
+        return
+    yield from _unwrap_dashboards(content)
+
+
+def _extract_file_metrics_with_stats(file_path, extract, drain_stats) -> (list, dict):
+    """Runs in a worker process: the file's dashboards together with the stats the worker collected for them."""
+    dashboards_metrics = extract_file_metrics(file_path, extract)
+    return dashboards_metrics, drain_stats()
+
+
+def extract_file_metrics(file_path, extract) -> list:
+    dashboards_metrics = []
+    try:
+        for dashboard in read_dashboards(file_path):
+            try:
+                dashboard_metrics = extract(dashboard)
+            except (KeyError, TypeError):
+                logger.error(f'Could not parse a dashboard in {file_path}, skipping it')
+                continue
+            if dashboard_metrics['metrics'] is not None:
+                dashboard_metrics['metrics'] = sorted(set(dashboard_metrics['metrics']))
+            dashboards_metrics.append(dashboard_metrics)
+    except (OSError, UnicodeDecodeError) as e:
+        logger.error(f'Could not read {file_path}, skipping it: {e}')
+    return dashboards_metrics
+
+
+def stream_folder_metrics(path, extract, workers=None, drain_stats=None, merge_stats=None):
+    """Runs extract(dashboard) for every dashboard under path on a process pool, yielding one entry per dashboard.
+
+    extract must be a module level function so it can be sent to the worker processes. When drain_stats is set, it
+    runs in the workers after every file and returns, then resets, the stats they collected; each result is handed
+    to merge_stats in this process. It also runs when a worker starts, so state inherited from this process is not
+    counted twice.
+    """
+    if not os.path.isdir(path):
+        raise ValueError(f'Dashboards folder not found: {path}')
+    file_paths = list(iter_dashboard_files(path))
+    workers = workers or os.cpu_count() or 1
+    logger.info(f'Found {len(file_paths)} dashboard files in {path}, extracting with {workers} workers')
+    extract_file = partial(extract_file_metrics, extract=extract)
+    if workers == 1:
+        for dashboards_metrics in map(extract_file, file_paths):
+            yield from dashboards_metrics
+        return
+    if drain_stats is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for dashboards_metrics in executor.map(extract_file, file_paths, chunksize=FILES_PER_TASK):
+                yield from dashboards_metrics
+        return
+    extract_file = partial(_extract_file_metrics_with_stats, extract=extract, drain_stats=drain_stats)
+    with ProcessPoolExecutor(max_workers=workers, initializer=drain_stats) as executor:
+        for dashboards_metrics, stats in executor.map(extract_file, file_paths, chunksize=FILES_PER_TASK):
+            if merge_stats is not None:
+                merge_stats(stats)
+            yield from dashboards_metrics
@@ -0,0 +1,362 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+IDENT = 'ident'
+NUMBER = 'number'
+STRING = 'string'
+VARIABLE = 'variable'
+RANGE = 'range'
+OPERATOR = 'operator'
+MATCH_OPERATOR = 'match_operator'
+LEFT_PAREN = '('
+RIGHT_PAREN = ')'
+LEFT_BRACE = '{'
+RIGHT_BRACE = '}'
+COMMA = ','
+
+IDENT_START_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_:')
+IDENT_CHARS = IDENT_START_CHARS | frozenset('0123456789')
+NUMBER_CHARS = IDENT_CHARS | frozenset('.')
+DIGITS = frozenset('0123456789')
+QUOTE_CHARS = frozenset('"\'`')
+MATCH_OPERATORS = frozenset(['=~', '!~', '!=', '='])
+OPERATORS = ('==', '=~', '!~', '!=', '>=', '<=', '=', '+', '-', '*', '/', '%', '^', '>', '<', '@')
+
+AGGREGATORS = frozenset(['sum', 'min', 'max', 'avg', 'group', 'stddev', 'stdvar', 'count', 'count_values', 'bottomk',
+                         'topk', 'quantile', 'limitk', 'limit_ratio'])
+GROUPING_KEYWORDS = frozenset(['by', 'without', 'on', 'ignoring', 'group_left', 'group_right'])
+FUSED_GROUPING_SUFFIXES = ('without', 'by')
+RESERVED_WORDS = frozenset(['bool', 'offset', 'and', 'or', 'unless', 'atan2', 'inf', 'nan']) | GROUPING_KEYWORDS | AGGREGATORS
+METRIC_NAME_LABEL = '__name__'
+# Label usage of a metric whose series identity is visible in the result, so none of its labels can be dropped
+ALL_LABELS = '*'
+AGGREGATION_CLAUSES = frozenset(['by', 'without'])
+LABEL_PRESERVING_AGGREGATORS = frozenset(['topk', 'bottomk', 'limitk', 'limit_ratio'])
+VECTOR_MATCHING_KEYWORDS = frozenset(['on', 'group_left', 'group_right'])
+IGNORING_KEYWORD = 'ignoring'
+LABEL_FUNCTIONS = frozenset(['label_replace', 'label_join'])
+LABEL_NAME_REGEX = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+class PromQLSyntaxError(ValueError):
+    pass
+
+
+class LabelMatcher(NamedTuple):
+    metric: Optional[str]
+    label: str
+    operator: str
+    value: str
+
+
+class ExpressionAnalysis(NamedTuple):
+    metrics: List[str]
+    rules: List[str]
+    matchers: List[LabelMatcher]
+    grouping_labels: List[str]
+    label_usage: Optional[Dict[str, List[str]]] = None
+
+
+def _read_string(expr, start):
+    quote = expr[start]
+    i = start + 1
+    chars = []
+    length = len(expr)
+    while i < length:
+        char = expr[i]
+        if char == '\\' and quote != '`' and i + 1 < length:
+            chars.append(expr[i + 1])
+            i += 2
+            continue
+        if char == quote:
+            return ''.join(chars), i + 1
+        chars.append(char)
+        i += 1
+    raise PromQLSyntaxError(f'Unterminated string at position {start}')
+
+
+def _skip_brackets(expr, start, opening, closing):
+    depth = 0
+    i = start
+    length = len(expr)
+    while i < length:
+        char = expr[i]
+        if char == opening:
+            depth += 1
+        elif char == closing:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise PromQLSyntaxError(f'Unbalanced "{opening}" at position {start}')
+
+
+def tokenize(expr) -> List[Tuple[str, str]]:
+    """Splits a PromQL expression into (kind, value) tokens.
+
+    Range and subquery selectors and Grafana template variables are collapsed into single tokens since they
+    never contain metric names.
+    """
+    tokens = []
+    i = 0
+    length = len(expr)
+    while i < length:
+        char = expr[i]
+        if char.isspace():
+            i += 1
+        elif char == '#':
+            newline = expr.find('\n', i)
+            i = length if newline == -1 else newline
+        elif char in IDENT_START_CHARS:
+            start = i
+            while i < length and expr[i] in IDENT_CHARS:
+                i += 1
+            tokens.append((IDENT, expr[start:i]))
+        elif char in DIGITS or (char == '.' and i + 1 < length and expr[i + 1] in DIGITS):
+            start = i
+            while i < length and expr[i] in NUMBER_CHARS:
+                i += 1
+            tokens.append((NUMBER, expr[start:i]))
+        elif char in QUOTE_CHARS:
+            value, i = _read_string(expr, i)
+            tokens.append((STRING, value))
+        elif char == '$':
+            start = i
+            if i + 1 < length and expr[i + 1] == '{':
+                i = _skip_brackets(expr, i + 1, '{', '}')
+            else:
+                i += 1
+                while i < length and expr[i] in IDENT_CHARS:
+                    i += 1
+            tokens.append((VARIABLE, expr[start:i]))
+        elif char == '[':
+            start = i
+            i = _skip_brackets(expr, i, '[', ']')
+            tokens.append((RANGE, expr[start:i]))
+        elif char in '(){},':
+            tokens.append((char, char))
+            i += 1
+        else:
+            for operator in OPERATORS:
+                if expr.startswith(operator, i):
+                    kind = MATCH_OPERATOR if operator in MATCH_OPERATORS else OPERATOR
+                    tokens.append((kind, operator))
+                    i += len(operator)
+                    break
+            else:
+                raise PromQLSyntaxError(f'Unexpected character "{char}" at position {i}')
+    return tokens
+
+
+def _is_grouping_keyword(name):
+    # Keywords and aggregators are case insensitive in PromQL, e.g. "sum(x) BY (job)"
+    name = name.lower()
+    if name in GROUPING_KEYWORDS:
+        return True
+    # Expressions that had their whitespace stripped fuse the aggregator with its clause, e.g. "sumby(job)"
+    for suffix in FUSED_GROUPING_SUFFIXES:
+        if name.endswith(suffix) and name[:-len(suffix)] in AGGREGATORS:
+            return True
+    return False
+
+
+def _read_grouping(tokens, start, grouping_labels):
+    i = start + 1
+    while i < len(tokens) and tokens[i][0] != RIGHT_PAREN:
+        kind, value = tokens[i]
+        if kind in (IDENT, STRING):
+            grouping_labels.append(value)
+        i += 1
+    return i + 1
+
+
+def _read_matchers(tokens, start, metric, matchers):
+    i = start + 1
+    quoted_name = None
+    while i < len(tokens) and tokens[i][0] != RIGHT_BRACE:
+        kind, value = tokens[i]
+        if kind in (IDENT, STRING) and i + 2 < len(tokens) and tokens[i + 1][0] == MATCH_OPERATOR:
+            matcher_value = tokens[i + 2][1]
+            matchers.append(LabelMatcher(metric, value, tokens[i + 1][1], matcher_value))
+            if value == METRIC_NAME_LABEL and tokens[i + 1][1] == '=':
+                quoted_name = matcher_value
+            i += 3
+            continue
+        if kind == STRING:
+            quoted_name = value
+        i += 1
+    return i + 1, quoted_name
+
+
+def _match_parens(tokens) -> dict:
+    parens = {}
+    opened = []
+    for i, (kind, _) in enumerate(tokens):
+        if kind == LEFT_PAREN:
+            opened.append(i)
+        elif kind == RIGHT_PAREN and opened:
+            parens[opened.pop()] = i
+    return parens
+
+
+def _clause_labels(tokens, start, end):
+    """Label names between a clause's parentheses, None when a template variable makes them unknown."""
+    labels = set()
+    for kind, value in tokens[start + 1:end]:
+        if kind == VARIABLE:
+            return None
+        if kind in (IDENT, STRING):
+            labels.add(value)
+    return labels
+
+
+def _split_aggregator(name) -> (Optional[str], Optional[str]):
+    name = name.lower()
+    if name in AGGREGATORS:
+        return name, None
+    for suffix in FUSED_GROUPING_SUFFIXES:
+        if name.endswith(suffix) and name[:-len(suffix)] in AGGREGATORS:
+            return name[:-len(suffix)], suffix
+    return None, None
+
+
+class _Scope:
+    """Body of an aggregation, with the labels its result keeps (None for all of them)."""
+
+    def __init__(self, start, end, labels):
+        self.start = start
+        self.end = end
+        self.labels = labels
+        self.matching_labels = set()
+        self.has_on = False
+        self.operands = 0
+
+
+def _aggregation_scopes(tokens, parens) -> list:
+    scopes = []
+    length = len(tokens)
+    for i, (kind, value) in enumerate(tokens):
+        if kind != IDENT:
+            continue
+        aggregator, clause = _split_aggregator(value)
+        if aggregator is None:
+            continue
+        j = i + 1
+        if clause is None and j < length and tokens[j][0] == IDENT and tokens[j][1].lower() in AGGREGATION_CLAUSES:
+            clause = tokens[j][1].lower()
+            j += 1
+        labels = set()
+        if clause is not None:
+            if j not in parens:
+                continue
+            labels = _clause_labels(tokens, j, parens[j])
+            j = parens[j] + 1
+        if j not in parens:
+            continue
+        end = parens[j]
+        if clause is None and end + 2 < length and tokens[end + 1][0] == IDENT and \
+                tokens[end + 1][1].lower() in AGGREGATION_CLAUSES and end + 2 in parens:
+            clause = tokens[end + 1][1].lower()
+            labels = _clause_labels(tokens, end + 2, parens[end + 2])
+        if clause == 'without' or aggregator in LABEL_PRESERVING_AGGREGATORS:
+            labels = None
+        scopes.append(_Scope(j, end, labels))
+    return scopes
+
+
+def _innermost_scope(scopes, position) -> Optional[_Scope]:
+    innermost = None
+    for scope in scopes:
+        if scope.start < position < scope.end and (innermost is None or scope.start > innermost.start):
+            innermost = scope
+    return innermost
+
+
+def _label_usage(tokens, occurrences, matchers) -> Dict[str, List[str]]:
+    """Labels each metric needs: the labels kept by its innermost aggregation, the labels of its matchers, and
+    the labels of vector matching and label functions around it. Metrics outside an aggregation, or under one
+    that keeps the series identity, need all of their labels."""
+    parens = _match_parens(tokens)
+    scopes = _aggregation_scopes(tokens, parens)
+    if scopes:
+        for i, (kind, value) in enumerate(tokens):
+            if kind != IDENT:
+                continue
+            scope = _innermost_scope(scopes, i)
+            if scope is None or scope.labels is None:
+                continue
+            keyword = value.lower()
+            if keyword == IGNORING_KEYWORD:
+                scope.labels = None
+            elif keyword in VECTOR_MATCHING_KEYWORDS:
+                scope.has_on = scope.has_on or keyword == 'on'
+                if i + 1 in parens:
+                    labels = _clause_labels(tokens, i + 1, parens[i + 1])
+                    if labels is None:
+                        scope.labels = None
+                    else:
+                        scope.matching_labels.update(labels)
+            elif value in LABEL_FUNCTIONS and i + 1 in parens:
+                scope.matching_labels.update(string for string_kind, string in tokens[i + 2:parens[i + 1]]
+                                             if string_kind == STRING and LABEL_NAME_REGEX.match(string))
+        for scope in scopes:
+            parent = _innermost_scope(scopes, scope.start)
+            if parent is not None:
+                parent.operands += 1
+        for _, position in occurrences:
+            scope = _innermost_scope(scopes, position)
+            if scope is not None:
+                scope.operands += 1
+    usage = {}
+    for name, position in occurrences:
+        scope = _innermost_scope(scopes, position)
+        # Vector operands of a binary operator without on() are matched on all of their labels
+        if scope is None or scope.labels is None or (scope.operands > 1 and not scope.has_on):
+            usage[name] = {ALL_LABELS}
+        elif ALL_LABELS not in usage.setdefault(name, set()):
+            usage[name].update(scope.labels, scope.matching_labels)
+    for matcher in matchers:
+        if matcher.metric in usage and ALL_LABELS not in usage[matcher.metric]:
+            usage[matcher.metric].add(matcher.label)
+    return {name: sorted(labels - {METRIC_NAME_LABEL}) for name, labels in usage.items()}
+
+
+def analyze(expr) -> ExpressionAnalysis:
+    """Extracts metric names, recording rules, label matchers, grouping labels and the labels each metric needs
+    from a PromQL expression."""
+    tokens = tokenize(expr)
+    names = []
+    occurrences = []
+    matchers = []
+    grouping_labels = []
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i]
+        next_kind = tokens[i + 1][0] if i + 1 < len(tokens) else None
+        if kind == IDENT:
+            if next_kind == LEFT_PAREN and _is_grouping_keyword(value):
+                i = _read_grouping(tokens, i + 1, grouping_labels)
+                continue
+            if next_kind == LEFT_PAREN or value.lower() in RESERVED_WORDS:
+                i += 1
+                continue
+            names.append(value)
+            occurrences.append((value, i))
+            if next_kind == LEFT_BRACE:
+                i, _ = _read_matchers(tokens, i + 1, value, matchers)
+                continue
+        elif kind == LEFT_BRACE:
+            first_matcher = len(matchers)
+            i, quoted_name = _read_matchers(tokens, i, None, matchers)
+            if quoted_name:
+                names.append(quoted_name)
+                occurrences.append((quoted_name, i - 1))
+                for j in range(first_matcher, len(matchers)):
+                    matchers[j] = matchers[j]._replace(metric=quoted_name)
+            continue
+        i += 1
+    names = list(dict.fromkeys(names))
+    metrics = [name for name in names if ':' not in name]
+    rules = [name for name in names if ':' in name]
+    return ExpressionAnalysis(metrics, rules, matchers, list(dict.fromkeys(grouping_labels)),
+                              _label_usage(tokens, occurrences, matchers))
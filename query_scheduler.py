@@ -0,0 +1,133 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from http_client import create_session
+from instrumentation import RUN_STATS
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_INITIAL_CONCURRENCY = 2
+DEFAULT_QUERY_TIMEOUT_SECONDS = 60
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_LATENCY_THRESHOLD_SECONDS = 5
+DEFAULT_BACKOFF_BASE_SECONDS = 0.5
+DEFAULT_BACKOFF_MAX_SECONDS = 30
+AIMD_DECREASE_FACTOR = 0.5
+RETRIES_STATS_NAME = 'scheduled queries'
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE_SECONDS, maximum=DEFAULT_BACKOFF_MAX_SECONDS) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class AIMDLimiter:
+    """Additive-increase/multiplicative-decrease concurrency limit.
+
+    The limit grows by one every time a full window of queries completes below the latency threshold, and is
+    halved when a query fails or is slow. Only queries started after the last decrease can decrease it again, so a
+    burst of failures from the same window counts once.
+    """
+
+    def __init__(self, initial_limit=DEFAULT_INITIAL_CONCURRENCY, min_limit=1, max_limit=DEFAULT_MAX_CONCURRENCY,
+                 latency_threshold=DEFAULT_LATENCY_THRESHOLD_SECONDS):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.latency_threshold = latency_threshold
+        self._limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def on_complete(self, started_at, success):
+        with self._lock:
+            latency = time.monotonic() - started_at
+            if success and latency <= self.latency_threshold:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            elif started_at >= self._last_decrease:
+                self._limit = max(self.min_limit, self._limit * AIMD_DECREASE_FACTOR)
+                self._last_decrease = time.monotonic()
+                logger.info(f'Prometheus is slow or failing (latency: {latency:.1f}s, success: {success}), '
+                            f'lowering query concurrency to {self.limit}')
+
+
+class QueryScheduler:
+    """Runs queries on a worker pool sharing one HTTP session, gated by an AIMD concurrency limit."""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                 query_timeout=DEFAULT_QUERY_TIMEOUT_SECONDS, max_retries=DEFAULT_MAX_RETRIES,
+                 latency_threshold=DEFAULT_LATENCY_THRESHOLD_SECONDS):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.query_timeout = query_timeout
+        self.max_retries = max_retries
+        self.limiter = AIMDLimiter(initial_concurrency, max_limit=self.max_concurrency,
+                                   latency_threshold=latency_threshold)
+        self.session = create_session(self.max_concurrency)
+
+    @classmethod
+    def from_config(cls, prometheus_config: dict):
+        return cls(max_concurrency=prometheus_config.get('max_concurrency') or DEFAULT_MAX_CONCURRENCY,
+                   query_timeout=prometheus_config.get('query_timeout') or DEFAULT_QUERY_TIMEOUT_SECONDS,
+                   max_retries=prometheus_config.get('max_retries', DEFAULT_MAX_RETRIES),
+                   latency_threshold=prometheus_config.get('latency_threshold') or DEFAULT_LATENCY_THRESHOLD_SECONDS)
+
+    def _execute(self, execute, task, attempt):
+        if attempt:
+            time.sleep(backoff_delay(attempt - 1))
+        started_at = time.monotonic()
+        try:
+            result = execute(self.session, task, self.query_timeout)
+        except Exception:
+            self.limiter.on_complete(started_at, False)
+            raise
+        self.limiter.on_complete(started_at, True)
+        return result
+
+    def run(self, tasks, execute, split=None):
+        """Yields (task, result, error) tuples as tasks complete.
+
+        execute(session, task, timeout) runs a single query. When it raises, split(task) may return smaller tasks
+        to run instead; otherwise the task is retried with backoff up to max_retries times before its error is
+        yielded.
+        """
+        pending = deque((task, 0) for task in tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while pending or running:
+                while pending and len(running) < max(1, self.limiter.limit):
+                    task, attempt = pending.popleft()
+                    running[executor.submit(self._execute, execute, task, attempt)] = (task, attempt)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, attempt = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        subtasks = split(task) if split else None
+                        if subtasks:
+                            pending.extend((subtask, 0) for subtask in subtasks)
+                        elif attempt < self.max_retries:
+                            logger.warning(f'Query failed with error: {e}, retrying (attempt {attempt + 1})...')
+                            RUN_STATS.record_retry(RETRIES_STATS_NAME)
+                            pending.append((task, attempt + 1))
+                        else:
+                            yield task, None, e
+                        continue
+                    yield task, result, None
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
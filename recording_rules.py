@@ -0,0 +1,229 @@
+import glob
+import logging
+import os
+
+import requests
+import yaml
+
+import label_usage
+import promql_parser
+from instrumentation import RUN_STATS
+
+logger = logging.getLogger()
+
+PROMETHEUS_RULES_URL = '/api/v1/rules'
+RECORDING_RULE_TYPE = 'recording'
+RULE_FILE_EXTENSIONS = ('.yml', '.yaml')
+DEFAULT_RULES_TIMEOUT_SECONDS = 30
+
+
+class RuleGraph:
+    """Dependency graph from each recording rule to the metrics and rules its expressions read.
+
+    Rule references are resolved transitively to the raw metrics they are computed from, and to the labels the
+    rules read of those metrics. Resolutions are cached until the graph changes, so each rule is walked once
+    however many dashboards and panels reference it.
+    """
+
+    def __init__(self):
+        self.dependencies = {}
+        self.label_usage = {}
+        self._resolved_labels = {}
+        self.hits = 0
+        self.misses = 0
+        self._resolved = {}
+        self._unknown_rules = set()
+
+    def __len__(self):
+        return len(self.dependencies)
+
+    def __contains__(self, name):
+        return name in self.dependencies
+
+    def add_rule(self, record, expr):
+        """Adds a recording rule. A record defined by several rules depends on the inputs of all of them."""
+        try:
+            analysis = promql_parser.analyze(str(expr))
+        except promql_parser.PromQLSyntaxError as e:
+            logger.error(f'Cannot parse the expression of recording rule {record}, skipping it, error: {e}')
+            return
+        self.dependencies.setdefault(record, set()).update(analysis.metrics + analysis.rules)
+        label_usage.merge_usage(self.label_usage.setdefault(record, {}), analysis.label_usage)
+        self._resolved.clear()
+        self._resolved_labels.clear()
+
+    def add_groups(self, groups) -> int:
+        """Adds the recording rules of rule groups, in the rule file format ({"rules": [{"record", "expr"}]}) or the
+        /api/v1/rules format ({"rules": [{"type": "recording", "name", "query"}]}). Alerting rules are ignored."""
+        count = 0
+        for group in groups or []:
+            for rule in group.get('rules') or []:
+                if rule.get('record'):
+                    self.add_rule(rule['record'], rule.get('expr', ''))
+                elif rule.get('type') == RECORDING_RULE_TYPE and rule.get('name'):
+                    self.add_rule(rule['name'], rule.get('query', ''))
+                else:
+                    continue
+                count += 1
+        return count
+
+    def _rule_components(self, name, resolved) -> list:
+        """Strongly connected components of the unresolved rules reachable from name, dependencies first. Rules that
+        depend on each other form one component, so a cycle is resolved as one unit whichever rule is asked first."""
+        order = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        def visit(rule):
+            order[rule] = low[rule] = len(order)
+            stack.append(rule)
+            on_stack.add(rule)
+            for dependency in self.dependencies[rule]:
+                if dependency not in self.dependencies or dependency in resolved:
+                    continue
+                if dependency not in order:
+                    visit(dependency)
+                    low[rule] = min(low[rule], low[dependency])
+                elif dependency in on_stack:
+                    low[rule] = min(low[rule], order[dependency])
+            if low[rule] == order[rule]:
+                component = []
+                while not component or component[-1] != rule:
+                    component.append(stack.pop())
+                    on_stack.discard(component[-1])
+                components.append(component)
+
+        visit(name)
+        return components
+
+    def resolve(self, name) -> frozenset:
+        """Raw metrics a metric or rule needs; a name that is not a recorded rule is its own raw metric."""
+        resolved = self._resolved.get(name)
+        if resolved is not None:
+            self.hits += 1
+            return resolved
+        self.misses += 1
+        if name not in self.dependencies:
+            resolved = self._resolved[name] = frozenset([name])
+            return resolved
+        for component in self._rule_components(name, self._resolved):
+            members = set(component)
+            if len(component) > 1 or component[0] in self.dependencies[component[0]]:
+                logger.error(f'Recording rules {sorted(members)} depend on each other, each of them needs the '
+                             f'metrics of all of them')
+            metrics = set()
+            for member in component:
+                for dependency in self.dependencies[member] - members:
+                    if dependency in self.dependencies:
+                        metrics.update(self._resolved[dependency])
+                    else:
+                        metrics.add(dependency)
+            resolved = frozenset(metrics)
+            for member in component:
+                self._resolved[member] = resolved
+        return self._resolved[name]
+
+    def resolve_labels(self, name) -> dict:
+        """Labels the rules behind name read of each raw metric they need."""
+        resolved = self._resolved_labels.get(name)
+        if resolved is not None:
+            return resolved
+        if name not in self.dependencies:
+            return {}
+        for component in self._rule_components(name, self._resolved_labels):
+            members = set(component)
+            usage = {}
+            for member in component:
+                for dependency, labels in self.label_usage.get(member, {}).items():
+                    if dependency in members:
+                        continue
+                    if dependency in self.dependencies:
+                        label_usage.merge_usage(usage, self._resolved_labels[dependency])
+                    else:
+                        label_usage.merge_usage(usage, {dependency: labels})
+            for member in component:
+                self._resolved_labels[member] = usage
+        return self._resolved_labels[name]
+
+    def expand(self, names) -> list:
+        """Replaces the rule references in names with the raw metrics they need."""
+        metrics = set()
+        for name in names:
+            if ':' in name and name not in self.dependencies and name not in self._unknown_rules:
+                self._unknown_rules.add(name)
+                logger.info(f'{name} is not a loaded recording rule, keeping it as a metric')
+            metrics.update(self.resolve(name))
+        return sorted(metrics)
+
+    def record_stats(self):
+        RUN_STATS.record_cache('recording rules', self.hits, self.misses)
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self.dependencies.clear()
+        self.label_usage.clear()
+        self._resolved.clear()
+        self._resolved_labels.clear()
+        self._unknown_rules.clear()
+
+
+def iter_rule_files(paths):
+    """Rule files of a list of files, directories and glob patterns."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    if file_name.endswith(RULE_FILE_EXTENSIONS):
+                        yield os.path.join(root, file_name)
+        else:
+            yield from sorted(glob.glob(path)) or [path]
+
+
+def load_rule_files(graph, paths) -> int:
+    count = 0
+    for file_path in iter_rule_files(paths):
+        try:
+            with open(file_path, 'r') as rule_file:
+                content = yaml.safe_load(rule_file) or {}
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f'Could not read rule file {file_path}, skipping it: {e}')
+            continue
+        count += graph.add_groups(content.get('groups'))
+    return count
+
+
+def load_prometheus_rules(graph, endpoint, timeout=DEFAULT_RULES_TIMEOUT_SECONDS) -> int:
+    try:
+        response = requests.get(endpoint + PROMETHEUS_RULES_URL, params={'type': 'record'}, timeout=timeout,
+                                hooks={'response': RUN_STATS.record_response})
+        response.raise_for_status()
+        return graph.add_groups(response.json()['data']['groups'])
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        logger.error(f'Could not load the recording rules of {endpoint}: {e}')
+        return 0
+
+
+def _prometheus_endpoints(config) -> list:
+    prometheus_config = config.get('prometheus')
+    targets = prometheus_config if isinstance(prometheus_config, list) else [prometheus_config or {}]
+    return [target['endpoint'] for target in targets if target.get('endpoint')]
+
+
+def load_from_config(graph, config: dict) -> int:
+    """Reloads the graph from the recording_rules block: rule files, and the rules of the configured Prometheus
+    servers when from_prometheus is set."""
+    rules_config = (config or {}).get('recording_rules') or {}
+    graph.clear()
+    count = 0
+    with RUN_STATS.stage('load recording rules'):
+        files = rules_config.get('files') or []
+        count += load_rule_files(graph, [files] if isinstance(files, str) else files)
+        if rules_config.get('from_prometheus'):
+            for endpoint in _prometheus_endpoints(config):
+                count += load_prometheus_rules(graph, endpoint)
+    if rules_config:
+        logger.info(f'Loaded {count} recording rules defining {len(graph)} metrics')
+    return count
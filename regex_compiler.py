@@ -0,0 +1,81 @@
+import re
+
+TERMINAL = ''
+
+
+def _build_trie(names) -> dict:
+    trie = {}
+    for name in names:
+        node = trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[TERMINAL] = {}
+    return trie
+
+
+def _is_single_char(alternative) -> bool:
+    return len(alternative) == 1 or (len(alternative) == 2 and alternative[0] == '\\')
+
+
+def _group(alternatives, optional) -> str:
+    if len(alternatives) == 1 and (_is_single_char(alternatives[0]) or not optional):
+        group = alternatives[0]
+    elif all(_is_single_char(alternative) for alternative in alternatives):
+        group = f'[{"".join(alternatives)}]'
+    else:
+        group = f'({"|".join(alternatives)})'
+    return f'{group}?' if optional else group
+
+
+def _emit(node) -> list:
+    """Returns the alternatives matching the suffixes below node, factoring shared prefixes when it is shorter."""
+    alternatives = []
+    for char, child in sorted((char, child) for char, child in node.items() if char != TERMINAL):
+        prefix = re.escape(char)
+        # Collapse single child chains into one literal edge
+        while len(child) == 1 and TERMINAL not in child:
+            (next_char, child), = child.items()
+            prefix += re.escape(next_char)
+        child_alternatives = _emit(child)
+        optional = TERMINAL in child
+        if not child_alternatives:
+            alternatives.append(prefix)
+            continue
+        factored = prefix + _group(child_alternatives, optional)
+        distributed = [prefix + alternative for alternative in child_alternatives] + ([prefix] if optional else [])
+        if len(factored) <= len('|'.join(distributed)):
+            alternatives.append(factored)
+        else:
+            alternatives.extend(distributed)
+    return alternatives
+
+
+def compile_regex(names) -> str:
+    """Compiles metric names into one prefix-factored alternation, e.g. kube_job_status_(active|failed)."""
+    return '|'.join(_emit(_build_trie(set(names))))
+
+
+def compile_regex_chunks(names, max_length=None) -> list:
+    """Splits the compiled regex into patterns of at most max_length characters each.
+
+    A factored pattern is never longer than the flat alternation of the same names, so sorted names are grouped by
+    their flat length. A single name longer than max_length gets a chunk of its own.
+    """
+    names = sorted(set(names))
+    if not max_length:
+        return [compile_regex(names)] if names else []
+    chunks = []
+    chunk = []
+    flat_length = 0
+    for name in names:
+        name_length = len(re.escape(name)) + (1 if chunk else 0)
+        if chunk and flat_length + name_length > max_length:
+            chunks.append(compile_regex(chunk))
+            chunk = []
+            name_length -= 1
+            flat_length = 0
+        chunk.append(name)
+        flat_length += name_length
+    if chunk:
+        chunks.append(compile_regex(chunk))
+    return chunks
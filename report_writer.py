@@ -0,0 +1,332 @@
+import csv
+import json
+import logging
+import os
+import sys
+
+import label_usage
+
+logger = logging.getLogger()
+
+REPORT_FORMAT_TEXT = 'text'
+REPORT_FORMAT_JSON = 'json'
+REPORT_FORMAT_NDJSON = 'ndjson'
+REPORT_FORMAT_CSV = 'csv'
+REPORT_FORMATS = [REPORT_FORMAT_TEXT, REPORT_FORMAT_JSON, REPORT_FORMAT_NDJSON, REPORT_FORMAT_CSV]
+DEFAULT_REPORT_FORMAT = REPORT_FORMAT_TEXT
+WRITE_BUFFER_SIZE = 1024 * 1024
+SEPARATOR = '------------'
+
+
+def format_telegraf_fieldpass(field_list):
+    return '[' + ','.join(f'"{field}"' for field in sorted(field_list)) + ']'
+
+
+def _telegraf_fieldpass(telegraf_mapping) -> dict:
+    return {input_name: sorted(fields) for input_name, fields in telegraf_mapping.items()}
+
+
+def _timeseries_record(interval, total_count, used_count, used_metrics_and_count, count_sources) -> dict:
+    return {'interval': interval, 'total_count': total_count, 'used_count': used_count,
+            'metrics': {metric: {'count': count, 'count_strategy': count_sources.get(metric)}
+                        for metric, count in used_metrics_and_count.items()}}
+
+
+def _label_savings_record(metric_estimates, relabel_rules) -> dict:
+    return {'series_before': sum(estimate['count'] for estimate in metric_estimates.values()),
+            'series_after_drop': sum(estimate['series_after_drop'] for estimate in metric_estimates.values()),
+            'metrics': metric_estimates, 'relabel_rules': relabel_rules}
+
+
+class ReportWriter:
+    """Base report writer. Dashboards are written as they finish, followed by the distinct metrics summary, the
+    sources of each metric when several Grafana sources were extracted, and the optional time series counts and
+    label savings estimates, once per Prometheus target."""
+
+    def __init__(self, stream=None, path=None):
+        self.path = path
+        self._owns_stream = stream is None and path is not None
+        if self._owns_stream:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            stream = open(path, 'w', buffering=WRITE_BUFFER_SIZE, newline='')
+        self.stream = stream or sys.stdout
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        raise NotImplementedError
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        raise NotImplementedError
+
+    def write_sources(self, metric_sources):
+        raise NotImplementedError
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        raise NotImplementedError
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        raise NotImplementedError
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self._owns_stream:
+            self.stream.close()
+            logger.info(f'Report written to {self.path}')
+        else:
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TextReportWriter(ReportWriter):
+    """The human readable output the extractor has always printed."""
+
+    def _regex_lines(self, patterns, telegraf_mapping) -> list:
+        if len(patterns) > 1:
+            lines = [f'As Prometheus regex, split into {len(patterns)} patterns:'] + patterns
+        else:
+            lines = ['As Prometheus regex: ', ''.join(patterns)]
+        lines += [SEPARATOR, 'Telegraf filter by input:']
+        lines += [f'{key} fieldpass regex: {format_telegraf_fieldpass(value)}' for key, value in telegraf_mapping.items()]
+        return lines
+
+    def _write_lines(self, lines):
+        self.stream.write('\n'.join(lines) + '\n')
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        lines = [SEPARATOR, f'Total number of metrics in {name} : {len(metrics)}', SEPARATOR] + list(metrics)
+        self._write_lines(lines + self._regex_lines(patterns, telegraf_mapping))
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        lines = [SEPARATOR, f'Total number of distinct metrics: {len(metrics)}', SEPARATOR] + list(metrics)
+        self._write_lines(lines + self._regex_lines(patterns, telegraf_mapping))
+
+    def write_sources(self, metric_sources):
+        lines = [SEPARATOR, 'Grafana sources by metric:', SEPARATOR]
+        lines += [f'{metric}: {", ".join(sources)}' for metric, sources in sorted(metric_sources.items())]
+        self._write_lines(lines)
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        lines = [SEPARATOR] + ([f'Prometheus target: {target}'] if target else [])
+        lines += [f'Total time series in the last {interval}: {total_count}',
+                  f'Used time series in the last {interval}: {used_count}', SEPARATOR]
+        lines += [f'{metric}: {count} ({count_sources.get(metric, "")})'
+                  for metric, count in sorted(used_metrics_and_count.items())]
+        self._write_lines(lines)
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        record = _label_savings_record(metric_estimates, relabel_rules)
+        lines = [SEPARATOR] + ([f'Prometheus target: {target}'] if target else [])
+        lines += [f'Used time series after dropping unused labels: {record["series_after_drop"]} of '
+                  f'{record["series_before"]}', SEPARATOR]
+        lines += [f'{metric}: {estimate["count"]} -> {estimate["series_after_drop"]} '
+                  f'(unused labels: {", ".join(estimate["unused_labels"])})'
+                  for metric, estimate in sorted(metric_estimates.items()) if estimate['unused_labels']]
+        if relabel_rules:
+            lines += [SEPARATOR, 'Relabel rules by projected series reduction:',
+                      label_usage.format_relabel_rules(relabel_rules)]
+        self._write_lines(lines)
+
+
+class JsonReportWriter(ReportWriter):
+    """Streams a single json document: {"dashboards": [...], "summary": {...}, "timeseries": {...},
+    "label_savings": {...}}.
+
+    Several Grafana sources add "metric_sources": {metric: [source, ...]}. Results of named Prometheus targets are
+    finished concurrently, so they are kept until the report closes and written under "timeseries_by_target" and
+    "label_savings_by_target": {target: {...}} instead.
+    """
+
+    def __init__(self, stream=None, path=None):
+        super().__init__(stream, path)
+        self.stream.write('{"dashboards": [')
+        self._dashboards_written = 0
+        self._dashboards_closed = False
+        self._by_target = {}
+
+    def _close_dashboards(self):
+        if not self._dashboards_closed:
+            self.stream.write(']')
+            self._dashboards_closed = True
+
+    def _write_section(self, section, record, target):
+        if target is not None:
+            self._by_target.setdefault(f'{section}_by_target', {})[target] = record
+            return
+        self._close_dashboards()
+        self.stream.write(f', "{section}": ')
+        json.dump(record, self.stream)
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        if self._dashboards_written:
+            self.stream.write(', ')
+        json.dump({'name': name, 'metrics': list(metrics), 'prometheus_regex': patterns,
+                   'telegraf_fieldpass': _telegraf_fieldpass(telegraf_mapping)}, self.stream)
+        self._dashboards_written += 1
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        self._close_dashboards()
+        self.stream.write(', "summary": ')
+        json.dump({'distinct_metrics_count': len(metrics), 'metrics': list(metrics), 'prometheus_regex': patterns,
+                   'telegraf_fieldpass': _telegraf_fieldpass(telegraf_mapping)}, self.stream)
+
+    def write_sources(self, metric_sources):
+        self._write_section('metric_sources', metric_sources, None)
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        self._write_section('timeseries', _timeseries_record(interval, total_count, used_count,
+                                                             used_metrics_and_count, count_sources), target)
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        self._write_section('label_savings', _label_savings_record(metric_estimates, relabel_rules), target)
+
+    def close(self):
+        self._close_dashboards()
+        for section, records in self._by_target.items():
+            self.stream.write(f', "{section}": ')
+            json.dump(records, self.stream)
+        self.stream.write('}\n')
+        super().close()
+
+
+class NdjsonReportWriter(ReportWriter):
+    """One json record per line, flushed as each dashboard finishes so consumers can tail the file."""
+
+    def _write_record(self, record):
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        self._write_record({'type': 'dashboard', 'name': name, 'metrics': list(metrics), 'prometheus_regex': patterns,
+                            'telegraf_fieldpass': _telegraf_fieldpass(telegraf_mapping)})
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        self._write_record({'type': 'summary', 'distinct_metrics_count': len(metrics), 'metrics': list(metrics),
+                            'prometheus_regex': patterns, 'telegraf_fieldpass': _telegraf_fieldpass(telegraf_mapping)})
+
+    def write_sources(self, metric_sources):
+        self._write_record({'type': 'metric_sources', 'metrics': metric_sources})
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        record = {'type': 'timeseries', 'target': target}
+        record.update(_timeseries_record(interval, total_count, used_count, used_metrics_and_count, count_sources))
+        self._write_record(record)
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        record = {'type': 'label_savings', 'target': target}
+        record.update(_label_savings_record(metric_estimates, relabel_rules))
+        self._write_record(record)
+
+
+class CsvReportWriter(ReportWriter):
+    """Flat rows of record, dashboard, metric, value, count_strategy, source. source is the Grafana source of a
+    metric_source row or the Prometheus target of a time series or label savings row. A metric_label_savings row
+    has the series left after dropping the unused labels as value and those labels as count_strategy, a
+    relabel_rule row has the dropped labels as metric, the series reduction as value and the action as
+    count_strategy."""
+
+    def __init__(self, stream=None, path=None):
+        super().__init__(stream, path)
+        self._writer = csv.writer(self.stream)
+        self._writer.writerow(['record', 'dashboard', 'metric', 'value', 'count_strategy', 'source'])
+
+    def _write_regex_rows(self, dashboard, patterns, telegraf_mapping):
+        self._writer.writerows(['prometheus_regex', dashboard, '', pattern, '', ''] for pattern in patterns)
+        self._writer.writerows(['telegraf_fieldpass', dashboard, input_name, format_telegraf_fieldpass(fields), '', '']
+                               for input_name, fields in telegraf_mapping.items())
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        self._writer.writerows(['dashboard_metric', name, metric, '', '', ''] for metric in metrics)
+        self._write_regex_rows(name, patterns, telegraf_mapping)
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        self._writer.writerows(['distinct_metric', '', metric, '', '', ''] for metric in metrics)
+        self._write_regex_rows('', patterns, telegraf_mapping)
+
+    def write_sources(self, metric_sources):
+        self._writer.writerows(['metric_source', '', metric, '', '', source]
+                               for metric, sources in sorted(metric_sources.items()) for source in sources)
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        target = target or ''
+        self._writer.writerow(['total_timeseries', '', '', total_count, '', target])
+        self._writer.writerow(['used_timeseries', '', '', used_count, '', target])
+        self._writer.writerows(['metric_timeseries', '', metric, count, count_sources.get(metric, ''), target]
+                               for metric, count in sorted(used_metrics_and_count.items()))
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        target = target or ''
+        self._writer.writerows(['metric_label_savings', '', metric, estimate['series_after_drop'],
+                                ' '.join(estimate['unused_labels']), target]
+                               for metric, estimate in sorted(metric_estimates.items()))
+        self._writer.writerows(['relabel_rule', '', ' '.join(entry['labels']), entry['reduction'],
+                                entry['rule']['action'], target] for entry in relabel_rules)
+
+
+class MultiReportWriter(ReportWriter):
+    """Writes the same report to several writers."""
+
+    def __init__(self, writers):
+        self.path = None
+        self.writers = list(writers)
+
+    def write_dashboard(self, name, metrics, patterns, telegraf_mapping):
+        for writer in self.writers:
+            writer.write_dashboard(name, metrics, patterns, telegraf_mapping)
+
+    def write_summary(self, metrics, patterns, telegraf_mapping):
+        for writer in self.writers:
+            writer.write_summary(metrics, patterns, telegraf_mapping)
+
+    def write_sources(self, metric_sources):
+        for writer in self.writers:
+            writer.write_sources(metric_sources)
+
+    def write_timeseries(self, interval, total_count, used_count, used_metrics_and_count, count_sources,
+                         target=None):
+        for writer in self.writers:
+            writer.write_timeseries(interval, total_count, used_count, used_metrics_and_count, count_sources,
+                                    target)
+
+    def write_label_savings(self, metric_estimates, relabel_rules, target=None):
+        for writer in self.writers:
+            writer.write_label_savings(metric_estimates, relabel_rules, target)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+REPORT_WRITERS = {
+    REPORT_FORMAT_TEXT: TextReportWriter,
+    REPORT_FORMAT_JSON: JsonReportWriter,
+    REPORT_FORMAT_NDJSON: NdjsonReportWriter,
+    REPORT_FORMAT_CSV: CsvReportWriter,
+}
+
+
+def create_report_writer(report_format=DEFAULT_REPORT_FORMAT, path=None) -> ReportWriter:
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f'Unsupported report format: {report_format}, supported formats: {REPORT_FORMATS}')
+    return REPORT_WRITERS[report_format](path=path)
+
+
+def from_config(config: dict) -> ReportWriter:
+    report_config = (config or {}).get('report') or {}
+    return create_report_writer(report_config.get('format') or DEFAULT_REPORT_FORMAT, report_config.get('path'))
@@ -1,6 +1,12 @@
+import argparse
 import logging
+import os
+
 import yaml
 
+import report_writer
+import timeseries_extractor
+
 logger = logging.getLogger()
 
 
@@ -15,9 +21,7 @@ def get_config() -> dict:
     config_path = input('Please enter config file path, or enter to insert input manually: ')
     if config_path is not None:
         try:
-            with open(f'{config_path}', 'r') as config:
-                config = yaml.safe_load(config)
-                return config
+            return load_config(config_path)
         except FileNotFoundError:
             grafana_endpoint = input('No config file found, please enter grafana endpoint: ')
             grafana_api_token = input('Please enter grafana api token: ')
@@ -27,3 +31,77 @@ def get_config() -> dict:
             return {'grafana': {'endpoint': grafana_endpoint, 'token': grafana_api_token},
                     'prometheus': {'endpoint': prometheus_endpoint,
                                    'timeseries_count_interval': prometheus_used_timeseries_interval}}
+
+
+def load_config(config_path) -> dict:
+    with open(f'{config_path}', 'r') as config:
+        return yaml.safe_load(config) or {}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Extract the metrics used by Grafana dashboards and count their Prometheus time series. '
+                    'Runs interactively when no arguments are given.')
+    parser.add_argument('--config', help='yaml config file, flags override its values')
+    parser.add_argument('--grafana-endpoint')
+    parser.add_argument('--grafana-token', help='defaults to the GRAFANA_TOKEN environment variable')
+    parser.add_argument('--prometheus-endpoint')
+    parser.add_argument('--timeseries-interval', help='prometheus timeseries count interval in minutes, i.e 5m')
+    parser.add_argument('--count-strategy', choices=timeseries_extractor.COUNT_STRATEGIES)
+    parser.add_argument('--label-savings', action='store_true',
+                        help='estimate the series saved by dropping the labels no dashboard reads')
+    parser.add_argument('--logzio-region', help='extract the dashboards of a Logz.io account in this region')
+    parser.add_argument('--logzio-token', help='defaults to the LOGZIO_API_TOKEN environment variable')
+    parser.add_argument('--dashboards-folder', help='extract the dashboards exported to this folder')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes extracting the dashboards folder, defaults to the number of cpus')
+    parser.add_argument('--report-format', choices=report_writer.REPORT_FORMATS)
+    parser.add_argument('--report-path')
+    parser.add_argument('--timings-path', help='write stage timings, request latencies and cache hit rates as json')
+    parser.add_argument('--profile-path', help='profile the main thread with cProfile and write the stats to this file')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, re-scan grafana on a schedule and serve the latest results over http')
+    parser.add_argument('--watch-interval', type=float, help='seconds between watch mode scans')
+    parser.add_argument('--listen', help='host:port of the watch mode http endpoint')
+    return parser.parse_args(argv)
+
+
+def _override(config, section, key, value):
+    if value is None:
+        return
+    target = config.setdefault(section, {}) if section else config
+    if target is None:
+        target = config[section] = {}
+    if isinstance(target, list):
+        raise ValueError(f'The config lists several {section} sources, set {key} per source in the config file '
+                         f'instead of with a flag')
+    target[key] = value
+
+
+def config_from_args(args: argparse.Namespace) -> dict:
+    config = load_config(args.config) if args.config else {}
+    _override(config, 'grafana', 'endpoint', args.grafana_endpoint)
+    _override(config, 'grafana', 'token', args.grafana_token)
+    _override(config, 'prometheus', 'endpoint', args.prometheus_endpoint)
+    _override(config, 'prometheus', 'timeseries_count_interval', args.timeseries_interval)
+    _override(config, 'prometheus', 'count_strategy', args.count_strategy)
+    if args.label_savings and not (config.get('prometheus') or {}).get('label_savings'):
+        _override(config, 'prometheus', 'label_savings', True)
+    _override(config, 'logzio', 'region', args.logzio_region)
+    _override(config, 'logzio', 'token', args.logzio_token)
+    _override(config, None, 'dashboards_folder', args.dashboards_folder)
+    _override(config, None, 'dashboards_folder_workers', args.workers)
+    _override(config, 'report', 'format', args.report_format)
+    _override(config, 'report', 'path', args.report_path)
+    _override(config, 'instrumentation', 'timings_path', args.timings_path)
+    _override(config, 'instrumentation', 'profile_path', args.profile_path)
+    _override(config, 'watch', 'interval', args.watch_interval)
+    _override(config, 'watch', 'listen', args.listen)
+    grafana_sources = config['grafana'] if isinstance(config.get('grafana'), list) else [config.get('grafana')]
+    for grafana_config in grafana_sources:
+        if grafana_config and not grafana_config.get('token') and os.environ.get('GRAFANA_TOKEN') \
+                and not grafana_config.get('logzio_region'):
+            grafana_config['token'] = os.environ['GRAFANA_TOKEN']
+    if config.get('logzio') and not config['logzio'].get('token') and os.environ.get('LOGZIO_API_TOKEN'):
+        config['logzio']['token'] = os.environ['LOGZIO_API_TOKEN']
+    return config
@@ -1,9 +1,16 @@
 import json
 import logging
 import re
+import time
+from typing import List, NamedTuple, Optional, Tuple
 
 import requests
 
+import label_usage
+from count_checkpoint import CountCheckpoint
+from instrumentation import RUN_STATS
+from query_scheduler import QueryScheduler
+
 logger = logging.getLogger()
 
 PROMETHEUS_BASE_QUERY_URL = '/api/v1/query'
@@ -17,7 +24,22 @@ PROMETHEUS_METRIC_NAME_PREFIX = '{__name__=~"'
 PROMETHEUS_METRIC_NAME_CLOSING_PERENTHESIS = '"}'
 PROMETHEUS_ACTIVE_TIMESERIES_INTERVAL_REGEX = r'^\d+m$'
 DEFAULT_TIMESERIES_COUNT_INTERVAL = '5m'
-MAX_QUERY_RETRIES = 4
+PROMETHEUS_COUNT_BY_NAME_PREFIX = 'count by (__name__)('
+PROMETHEUS_METRIC_NAME_LABEL = '__name__'
+COUNT_STRATEGY_BATCHED = 'batched'
+COUNT_STRATEGY_PER_METRIC = 'per_metric'
+COUNT_STRATEGY_TSDB_STATUS = 'tsdb_status'
+COUNT_STRATEGIES = [COUNT_STRATEGY_BATCHED, COUNT_STRATEGY_PER_METRIC, COUNT_STRATEGY_TSDB_STATUS]
+PROMETHEUS_TSDB_STATUS_URL = '/api/v1/status/tsdb'
+TSDB_STATUS_LIMIT = 1000000
+DEFAULT_COUNT_STRATEGY = COUNT_STRATEGY_BATCHED
+# Keeps batched queries well below common proxy/server request size limits (8KB) and heavy queries within the timeout
+MAX_BATCH_QUERY_LENGTH = 6000
+MAX_BATCH_SIZE = 200
+PROMETHEUS_LABELS_URL = '/api/v1/labels'
+# Aggregating without a label drops the metric name, so the name is copied to this label first
+METRIC_NAME_COPY_LABEL = '__metric_name__'
+SECONDS_PER_MINUTE = 60
 
 
 def _count_prometheus_total_timeseries(response) -> int:
@@ -34,89 +56,430 @@ def _count_prometheus_total_timeseries(response) -> int:
     return timeseries_count
 
 
-def get_prometheus_timeseries_count(config: dict, metrics):
-    used_timeseries_count = 0
+class LabelCountTask(NamedTuple):
+    """Batched count of the series each metric would have when counted by labels, or without dropped_label."""
+    metrics: List[str]
+    labels: Tuple[str, ...] = ()
+    dropped_label: Optional[str] = None
+
+
+def get_prometheus_timeseries_count(config: dict, metrics, report=None, metrics_label_usage=None):
     try:
         prometheus_config = config['prometheus']
         if prometheus_config.get('endpoint'):
-            timeseries_interval = extract_timeseries_interval(prometheus_config)
-            total_timeseries_count = _get_total_timeseries_count(prometheus_config.get('endpoint'), timeseries_interval)
-            if metrics:
-                used_timeseries_count, used_metrics_and_count = _get_used_timeseries_count(
-                    prometheus_config.get('endpoint'),
-                    timeseries_interval, metrics)
-            else:
-                logger.error(
-                    "An error occurred when fetching distinct metrics from grafana dashboards, skipping count of used "
-                    "timeseries count")
-            if total_timeseries_count:
-                logger.info(f'*** Total time series in the last {timeseries_interval}: {total_timeseries_count} ***')
-                logger.info(f'*** Used time series in the last {timeseries_interval}: {used_timeseries_count} ***')
-                if used_timeseries_count > 0:
-                    logger.info(f"*** Detailed metrics and count:\n{json.dumps(used_metrics_and_count)} ***")
+            timeseries_count = count_prometheus_timeseries(prometheus_config, metrics)
+            report_timeseries_count(timeseries_count, report)
+            if metrics_label_usage is not None and label_savings_config(prometheus_config) is not None:
+                report_label_savings(estimate_label_savings(prometheus_config, timeseries_count[3],
+                                                            metrics_label_usage), prometheus_config, report)
         else:
             logger.info("No prometheus endpoint found, skipping timeseries count")
     except KeyError:
         logger.error('Invalid config for prometheus server, skipping time series count')
 
 
+def count_prometheus_timeseries(prometheus_config: dict, metrics, target=None) -> (str, int, int, dict, dict):
+    """Total and per metric used time series of one Prometheus server, as (interval, total_count, used_count,
+    used_metrics_and_count, count_sources). target names the server when several are counted."""
+    used_timeseries_count = 0
+    used_metrics_and_count = {}
+    count_sources = {}
+    timeseries_interval = extract_timeseries_interval(prometheus_config)
+    with RUN_STATS.stage('count total time series'):
+        total_timeseries_count = _get_total_timeseries_count(prometheus_config.get('endpoint'), timeseries_interval)
+    if metrics:
+        count_strategy = extract_count_strategy(prometheus_config)
+        checkpoint = CountCheckpoint.from_config(prometheus_config, metrics, timeseries_interval, count_strategy,
+                                                 target)
+        with QueryScheduler.from_config(prometheus_config) as scheduler, RUN_STATS.stage('count used time series'):
+            used_timeseries_count, used_metrics_and_count, count_sources, _ = _get_used_timeseries_count(
+                prometheus_config.get('endpoint'), timeseries_interval, metrics, count_strategy, scheduler, checkpoint)
+    else:
+        logger.error(
+            "An error occurred when fetching distinct metrics from grafana dashboards, skipping count of used "
+            "timeseries count")
+    return timeseries_interval, total_timeseries_count, used_timeseries_count, used_metrics_and_count, count_sources
+
+
+def report_timeseries_count(timeseries_count, report=None, target=None):
+    timeseries_interval, total_timeseries_count, used_timeseries_count, used_metrics_and_count, count_sources = \
+        timeseries_count
+    if not total_timeseries_count:
+        return
+    prefix = f'{target}: ' if target else ''
+    logger.info(f'*** {prefix}Total time series in the last {timeseries_interval}: {total_timeseries_count} ***')
+    logger.info(f'*** {prefix}Used time series in the last {timeseries_interval}: {used_timeseries_count} ***')
+    if report is not None:
+        report.write_timeseries(timeseries_interval, total_timeseries_count, used_timeseries_count,
+                                used_metrics_and_count, count_sources, target)
+    elif used_timeseries_count > 0:
+        logger.info(f"*** {prefix}Detailed metrics and count:\n{json.dumps(used_metrics_and_count)} ***")
+        logger.info(f"*** {prefix}Count strategy per metric:\n{json.dumps(count_sources)} ***")
+
+
+def label_savings_config(prometheus_config: dict):
+    """Options of the label_savings block, None when the estimate is off."""
+    options = prometheus_config.get('label_savings')
+    if not options:
+        return None
+    return options if isinstance(options, dict) else {}
+
+
+def estimate_label_savings(prometheus_config: dict, used_metrics_and_count: dict, metrics_label_usage,
+                           scheduler=None) -> (dict, list):
+    """Estimates, per used metric, the series left after dropping the labels no dashboard reads, and builds
+    relabel rules ranked by projected series reduction.
+
+    Returns (metric_estimates, relabel_rules). Series that only differ by a dropped label collapse into one, so
+    the reduction is only realized where the collapsed series are aggregated or the label is redundant.
+    """
+    options = label_savings_config(prometheus_config) or {}
+    endpoint = prometheus_config['endpoint']
+    interval = extract_timeseries_interval(prometheus_config)
+    keep_labels = set(options.get('keep_labels', label_usage.DEFAULT_KEEP_LABELS)) | \
+        metrics_label_usage.global_labels | {PROMETHEUS_METRIC_NAME_LABEL}
+    series_counts = {metric: count for metric, count in used_metrics_and_count.items() if count > 0}
+    query_scheduler = scheduler or QueryScheduler.from_config(prometheus_config)
+    try:
+        with RUN_STATS.stage('estimate label savings'):
+            label_names = _get_metrics_label_names(endpoint, interval, list(series_counts), query_scheduler)
+            kept_labels = {}
+            for metric, names in label_names.items():
+                needed = metrics_label_usage.labels(metric)
+                kept_labels[metric] = set(names) if needed is None else (needed | keep_labels) & set(names)
+            unused_labels = {metric: set(names) - kept_labels[metric] for metric, names in label_names.items()}
+            tasks = [LabelCountTask(metrics, labels) for labels, metrics in _group_by_labels(
+                {metric: kept_labels[metric] for metric in unused_labels if unused_labels[metric]}).items()]
+            metrics_by_unused_label = {}
+            for metric, labels in unused_labels.items():
+                for label in labels:
+                    metrics_by_unused_label.setdefault(label, []).append(metric)
+            tasks += [LabelCountTask(sorted(metrics), dropped_label=label)
+                      for label, metrics in metrics_by_unused_label.items()]
+            needed_anywhere = set().union(*kept_labels.values()) if kept_labels else set()
+            labelkeep_labels = {metric: set(names) & needed_anywhere for metric, names in label_names.items()
+                                if set(names) - needed_anywhere}
+            tasks += [LabelCountTask(metrics, labels, dropped_label=None) for labels, metrics in _group_by_labels(
+                {metric: labels for metric, labels in labelkeep_labels.items()
+                 if labels != kept_labels[metric]}).items()]
+            counts = _run_label_count_tasks(endpoint + PROMETHEUS_BASE_QUERY_URL, interval,
+                                            [task._replace(metrics=batch) for task in tasks
+                                             for batch in _split_into_batches(task.metrics, interval,
+                                                                              _label_count_query(task))],
+                                            query_scheduler)
+    finally:
+        if scheduler is None:
+            query_scheduler.close()
+    metric_estimates = {}
+    for metric, names in label_names.items():
+        series_after = counts.get((_labels_key(kept_labels[metric]), None), {}).get(metric) \
+            if unused_labels[metric] else series_counts[metric]
+        if series_after is None:
+            continue
+        metric_estimates[metric] = {'count': int(series_counts[metric]), 'series_after_drop': int(series_after),
+                                    'used_labels': sorted(kept_labels[metric] - {PROMETHEUS_METRIC_NAME_LABEL}),
+                                    'unused_labels': sorted(unused_labels[metric])}
+    label_drop_counts = {label: {metric: count for metric, count in counts.get(((), label), {}).items()
+                                 if metric in metrics}
+                         for label, metrics in metrics_by_unused_label.items()}
+    labelkeep_counts = {}
+    for metric, labels in labelkeep_labels.items():
+        labelkeep_counts[metric] = counts.get((_labels_key(labels), None), {}).get(metric)
+    if None in labelkeep_counts.values() or len(label_names) < len(series_counts):
+        labelkeep_counts = {}
+    relabel_rules = label_usage.build_relabel_rules(series_counts, label_names, kept_labels,
+                                                    {label: label_counts for label, label_counts in
+                                                     label_drop_counts.items() if label_counts},
+                                                    labelkeep_counts)
+    return metric_estimates, relabel_rules
+
+
+def report_label_savings(label_savings, prometheus_config, report=None, target=None):
+    metric_estimates, relabel_rules = label_savings
+    prefix = f'{target}: ' if target else ''
+    before = sum(estimate['count'] for estimate in metric_estimates.values())
+    after = sum(estimate['series_after_drop'] for estimate in metric_estimates.values())
+    logger.info(f'*** {prefix}Dropping the labels no dashboard reads would leave {after} of {before} used time '
+                f'series, {len(relabel_rules)} relabel rules suggested ***')
+    rules_path = (label_savings_config(prometheus_config) or {}).get('rules_path')
+    if rules_path:
+        label_usage.save_relabel_rules(relabel_rules, rules_path)
+    if report is not None:
+        report.write_label_savings(metric_estimates, relabel_rules, target)
+    elif relabel_rules:
+        logger.info(f'*** {prefix}Relabel rules by projected series reduction:\n'
+                    f'{label_usage.format_relabel_rules(relabel_rules)} ***')
+
+
+def _labels_key(labels) -> tuple:
+    return tuple(sorted(set(labels) - {PROMETHEUS_METRIC_NAME_LABEL}))
+
+
+def _group_by_labels(metrics_labels: dict) -> dict:
+    """Groups metrics counted by the same labels, so they share batched queries."""
+    groups = {}
+    for metric, labels in sorted(metrics_labels.items()):
+        groups.setdefault(_labels_key(labels), []).append(metric)
+    return groups
+
+
+def _get_label_names(session, endpoint, metric, interval, timeout) -> list:
+    params = {'match[]': f'{{{PROMETHEUS_METRIC_NAME_LABEL}="{metric}"}}',
+              'start': time.time() - int(interval[:-1]) * SECONDS_PER_MINUTE}
+    response = session.get(endpoint + PROMETHEUS_LABELS_URL, params=params, timeout=timeout + 5)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'status code: {response.status_code}, message: {response.text}')
+    data = json.loads(response.text)
+    if data.get('status') != 'success':
+        raise ValueError(f"{data.get('errorType')}: {data.get('error')}")
+    return data.get('data') or []
+
+
+def _get_metrics_label_names(endpoint, interval, metrics, scheduler) -> dict:
+    def execute(session, batch, timeout):
+        return _get_label_names(session, endpoint, batch[0], interval, timeout)
+
+    label_names = {}
+    for batch, names, error in scheduler.run([[metric] for metric in metrics], execute):
+        if error is not None:
+            logger.error(f"Failed fetching the label names of {batch[0]}, skipping its label savings. error: {error}")
+            continue
+        label_names[batch[0]] = names
+    return label_names
+
+
+def _label_count_query(task):
+    def build_query(metrics, used_timeseries_interval):
+        return _build_label_count_query(task._replace(metrics=metrics), used_timeseries_interval)
+    return build_query
+
+
+def _build_label_count_query(task, used_timeseries_interval):
+    selector = _build_last_over_time_selector(task.metrics, used_timeseries_interval)
+    if task.dropped_label is None:
+        grouping = ', '.join((PROMETHEUS_METRIC_NAME_LABEL,) + task.labels)
+        return f'{PROMETHEUS_COUNT_BY_NAME_PREFIX}count by ({grouping})({selector}))'
+    return f'count by ({METRIC_NAME_COPY_LABEL})(count without ({task.dropped_label})(label_replace(' \
+           f'{selector}, "{METRIC_NAME_COPY_LABEL}", "$1", "{PROMETHEUS_METRIC_NAME_LABEL}", "(.+)")))'
+
+
+def _split_label_count_task(task):
+    if len(task.metrics) == 1:
+        return None
+    middle = len(task.metrics) // 2
+    return [task._replace(metrics=task.metrics[:middle]), task._replace(metrics=task.metrics[middle:])]
+
+
+def _run_label_count_tasks(query_url, used_timeseries_interval, tasks, scheduler) -> dict:
+    """Series counts per metric, keyed by (labels, dropped_label) of the tasks that produced them."""
+    def execute(session, task, timeout):
+        name_label = PROMETHEUS_METRIC_NAME_LABEL if task.dropped_label is None else METRIC_NAME_COPY_LABEL
+        results = _query_prometheus(session, query_url, _build_label_count_query(task, used_timeseries_interval),
+                                    timeout, method='POST')
+        return {result['metric'].get(name_label): int(float(result['value'][1])) for result in results}
+
+    counts = {}
+    for task, task_counts, error in scheduler.run(tasks, execute, _split_label_count_task):
+        if error is not None:
+            logger.error(f"Failed estimating label savings for metrics: {task.metrics}, with error: {error}")
+            continue
+        counts.setdefault((task.labels, task.dropped_label), {}).update(task_counts)
+    return counts
+
+
 def extract_timeseries_interval(prometheus_config):
     timeseries_interval = prometheus_config.get('timeseries_count_interval')
-    if timeseries_interval and not re.match(PROMETHEUS_ACTIVE_TIMESERIES_INTERVAL_REGEX,
-                                            timeseries_interval):
+    if not timeseries_interval or not re.match(PROMETHEUS_ACTIVE_TIMESERIES_INTERVAL_REGEX,
+                                               timeseries_interval):
         logger.info(
             f"Timeseries count interval was not entered or invalid, using default of {DEFAULT_TIMESERIES_COUNT_INTERVAL}")
         timeseries_interval = DEFAULT_TIMESERIES_COUNT_INTERVAL
     return timeseries_interval
 
 
-def _get_used_timeseries_count(endpoint, used_timeseries_interval, metrics) -> (int, dict):
+def extract_count_strategy(prometheus_config):
+    count_strategy = prometheus_config.get('count_strategy') or DEFAULT_COUNT_STRATEGY
+    if count_strategy not in COUNT_STRATEGIES:
+        logger.info(f"Unknown timeseries count strategy: {count_strategy}, using default of {DEFAULT_COUNT_STRATEGY}")
+        count_strategy = DEFAULT_COUNT_STRATEGY
+    return count_strategy
+
+
+def _get_used_timeseries_count(endpoint, used_timeseries_interval, metrics,
+                               count_strategy=DEFAULT_COUNT_STRATEGY, scheduler=None,
+                               checkpoint=None) -> (int, dict, dict, list):
     query_url = endpoint + PROMETHEUS_BASE_QUERY_URL
-    used_timeseries_sum = 0
-    query_retry_count = 1
-    used_metrics_and_count = {}
-    count_sum, failed_metrics = count_active_timeseries_for_metrics(metrics, query_url,
-                                                                    used_timeseries_interval,
-                                                                    used_metrics_and_count)
-    used_timeseries_sum += count_sum
-    while (len(failed_metrics) > 0 and query_retry_count <= MAX_QUERY_RETRIES):
-        logger.warn(
-            f"There was an issue querying prometheus for some of the metrics, retrying (attempt {query_retry_count})...")
-        count_sum, failed_metrics = count_active_timeseries_for_metrics(failed_metrics,
-                                                                        query_url,
-                                                                        used_timeseries_interval,
-                                                                        used_metrics_and_count)
-        query_retry_count += 1
+    checkpoint = checkpoint if checkpoint is not None else CountCheckpoint(metrics=metrics,
+                                                                           interval=used_timeseries_interval)
+    used_metrics_and_count, count_sources = checkpoint.counts()
+    pending_metrics = checkpoint.pending(metrics)
+    if len(pending_metrics) < len(metrics):
+        logger.info(f"{len(metrics) - len(pending_metrics)} metrics were already counted, "
+                    f"counting the remaining {len(pending_metrics)}")
+    metrics = pending_metrics
+    query_counts = {}
+    failed_metrics = []
+    query_scheduler = scheduler or QueryScheduler()
+    try:
+        if count_strategy == COUNT_STRATEGY_TSDB_STATUS:
+            if metrics:
+                tsdb_counts = {}
+                metrics = count_timeseries_from_tsdb_status(endpoint, metrics, tsdb_counts, count_sources,
+                                                            query_scheduler)
+                checkpoint.record_counts(list(tsdb_counts), tsdb_counts, COUNT_STRATEGY_TSDB_STATUS)
+                used_metrics_and_count.update(tsdb_counts)
+            count_strategy = COUNT_STRATEGY_BATCHED
+            if metrics:
+                logger.info(f"{len(metrics)} metrics were not found in the TSDB status, counting them with queries")
+        _, failed_metrics = count_active_timeseries_for_metrics(metrics, query_url, used_timeseries_interval,
+                                                                query_counts, count_strategy, query_scheduler,
+                                                                checkpoint)
+    finally:
+        if scheduler is None:
+            query_scheduler.close()
+        checkpoint.save()
+    used_metrics_and_count.update(query_counts)
+    count_sources.update({metric: count_strategy for metric in query_counts})
     if len(failed_metrics) > 0:
         logger.error(f"Some of the metric queries could not be completed due to errors: {failed_metrics}")
-    return int(count_sum), used_metrics_and_count
+    return sum(used_metrics_and_count.values()), used_metrics_and_count, count_sources, failed_metrics
+
+
+def _get_tsdb_series_counts(session, endpoint, timeout) -> dict:
+    response = session.get(endpoint + PROMETHEUS_TSDB_STATUS_URL, params={'limit': TSDB_STATUS_LIMIT}, timeout=timeout)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'status code: {response.status_code}, message: {response.text}')
+    data = json.loads(response.text)
+    series_count_by_metric = data.get('data', {}).get('seriesCountByMetricName') or []
+    return {entry['name']: int(entry['value']) for entry in series_count_by_metric}
+
+
+def count_timeseries_from_tsdb_status(endpoint, metrics, used_metrics_and_count, count_sources, scheduler) -> list:
+    """Fills in head block series counts from the TSDB status API and returns the metrics it has no count for."""
+    try:
+        series_counts = _get_tsdb_series_counts(scheduler.session, endpoint, scheduler.query_timeout)
+    except Exception as e:
+        logger.error(f"Failed fetching prometheus TSDB status, falling back to count queries. error: {e}")
+        return list(metrics)
+    logger.info(f"Prometheus TSDB status returned series counts for {len(series_counts)} metrics")
+    missing_metrics = []
+    for metric in metrics:
+        if metric in series_counts:
+            used_metrics_and_count[metric] = series_counts[metric]
+            count_sources[metric] = COUNT_STRATEGY_TSDB_STATUS
+        else:
+            missing_metrics.append(metric)
+    return missing_metrics
+
+
+def _build_metric_query(metric, used_timeseries_interval):
+    return PROMETHEUS_COUNT_FUNCTION_PREFIX + PROMETHEUS_LAST_OVER_TIME_QUERY_PREFIX + PROMETHEUS_METRIC_NAME_PREFIX + \
+        metric + PROMETHEUS_METRIC_NAME_CLOSING_PERENTHESIS + f'[{used_timeseries_interval}' + \
+        PROMETHEUS_INTERVAL_TIME_FUNCTION_SUFFIX + CLOSING_PERENTHESIS
+
 
+def _build_last_over_time_selector(metrics, used_timeseries_interval):
+    metrics_regex = '|'.join(re.escape(metric).replace('\\', '\\\\') for metric in metrics)
+    return PROMETHEUS_LAST_OVER_TIME_QUERY_PREFIX + PROMETHEUS_METRIC_NAME_PREFIX + metrics_regex + \
+        PROMETHEUS_METRIC_NAME_CLOSING_PERENTHESIS + f'[{used_timeseries_interval}' + \
+        PROMETHEUS_INTERVAL_TIME_FUNCTION_SUFFIX
 
-def count_active_timeseries_for_metrics(metrics, query_url,
-                                        used_timeseries_interval, used_metrics_and_count):
-    metric_base_query = PROMETHEUS_COUNT_FUNCTION_PREFIX + PROMETHEUS_LAST_OVER_TIME_QUERY_PREFIX + PROMETHEUS_METRIC_NAME_PREFIX
+
+def _build_batch_query(metrics, used_timeseries_interval):
+    return PROMETHEUS_COUNT_BY_NAME_PREFIX + _build_last_over_time_selector(metrics, used_timeseries_interval) + \
+        CLOSING_PERENTHESIS
+
+
+def _split_into_batches(metrics, used_timeseries_interval, build_query=_build_batch_query) -> list:
+    batches = []
+    batch = []
+    base_query_length = len(build_query([], used_timeseries_interval))
+    query_length = base_query_length
+    for metric in metrics:
+        metric_length = len(metric) + 1
+        if batch and (len(batch) >= MAX_BATCH_SIZE or query_length + metric_length > MAX_BATCH_QUERY_LENGTH):
+            batches.append(batch)
+            batch = []
+            query_length = base_query_length
+        batch.append(metric)
+        query_length += metric_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _split_batch(batch):
+    if len(batch) == 1:
+        return None
+    logger.warn(f"Failed querying a batch of {len(batch)} metrics, splitting it in half")
+    middle = len(batch) // 2
+    return [batch[:middle], batch[middle:]]
+
+
+def _query_prometheus(session, query_url, query, timeout, method='GET') -> list:
+    params = {'query': query, 'timeout': f'{timeout}s'}
+    if method == 'POST':
+        response = session.post(query_url, data=params, timeout=timeout + 5)
+    else:
+        response = session.get(query_url, params=params, timeout=timeout + 5)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'status code: {response.status_code}, message: {response.text}')
+    if not response.text:
+        logger.warn(f"Empty response for query {query}")
+        return []
+    data = json.loads(response.text)
+    if data.get('status') != 'success':
+        raise ValueError(f"{data.get('errorType')}: {data.get('error')}")
+    return data.get('data', {}).get('result', [])
+
+
+def _count_metrics(session, query_url, metrics, used_timeseries_interval, count_strategy, timeout) -> dict:
+    if count_strategy == COUNT_STRATEGY_BATCHED:
+        logger.info(f"Prometheus used timeseries batch count query for {len(metrics)} metrics")
+        results = _query_prometheus(session, query_url, _build_batch_query(metrics, used_timeseries_interval),
+                                    timeout, method='POST')
+        return {result['metric'][PROMETHEUS_METRIC_NAME_LABEL]: float(result['value'][1]) for result in results}
+    metric_get_query = _build_metric_query(metrics[0], used_timeseries_interval)
+    logger.info(f"Prometheus used timeseries count query: {metric_get_query}")
+    results = _query_prometheus(session, query_url, metric_get_query, timeout)
+    if not results:
+        return {}
+    return {metrics[0]: float(results[0]['value'][1])}
+
+
+def count_active_timeseries_for_metrics(metrics, query_url, used_timeseries_interval, used_metrics_and_count,
+                                        count_strategy=COUNT_STRATEGY_PER_METRIC, scheduler=None, checkpoint=None):
     used_timeseries_sum = 0
     failed_metrics = []
-    for i, metric in enumerate(metrics):
-        metric_get_query = metric_base_query + metric + PROMETHEUS_METRIC_NAME_CLOSING_PERENTHESIS + f'[{used_timeseries_interval}' + PROMETHEUS_INTERVAL_TIME_FUNCTION_SUFFIX + CLOSING_PERENTHESIS
-        logger.info(f"Prometheus used timeseries count query: {metric_get_query}")
-        try:
-            response = requests.get(query_url, params={"query": metric_get_query})
-            if not response.text:
-                logger.warn(f"Empty response for query {metric_get_query}")
-                continue
-            data = json.loads(response.text)
-            result_length = len(data.get('data', {}).get('result', []))
-            if not result_length:
-                logger.warn(f"Empty result for query {metric_get_query}")
+    if count_strategy == COUNT_STRATEGY_BATCHED:
+        tasks = _split_into_batches(metrics, used_timeseries_interval)
+    else:
+        tasks = [[metric] for metric in metrics]
+
+    def execute(session, batch, timeout):
+        return _count_metrics(session, query_url, batch, used_timeseries_interval, count_strategy, timeout)
+
+    query_scheduler = scheduler or QueryScheduler()
+    split = _split_batch if count_strategy == COUNT_STRATEGY_BATCHED else None
+    try:
+        for batch, counts, error in query_scheduler.run(tasks, execute, split):
+            if error is not None:
+                failed_metrics.extend(batch)
+                logger.error(f"Failed querying metrics: {batch}, with error: {error}")
+                if checkpoint is not None:
+                    checkpoint.record_failure(batch, error)
                 continue
-            value = float(data['data']['result'][0]['value'][1])
-            logger.info(f"None empty result with value: {value}")
-            used_timeseries_sum += value
-            used_metrics_and_count[metric] = int(value)
-        except Exception as e:
-            failed_metrics.append(metric)
-            logger.error(f"Failed querying metric: {metric}, with error: {e}")
+            if checkpoint is not None:
+                checkpoint.record_counts(batch, counts, count_strategy)
+            for metric in batch:
+                if metric not in counts:
+                    logger.warn(f"Empty result for metric {metric}")
+                    continue
+                used_timeseries_sum += counts[metric]
+                used_metrics_and_count[metric] = int(counts[metric])
+    finally:
+        if scheduler is None:
+            query_scheduler.close()
     return used_timeseries_sum, failed_metrics
 
 
@@ -125,7 +488,7 @@ def _get_total_timeseries_count(endpoint, total_count_timeseries_interval) -> in
     logger.info(f"Prometheus total timeseries count query url: {total_timeseries_count_url}")
     try:
         response = requests.get(
-            total_timeseries_count_url)
+            total_timeseries_count_url, hooks={'response': RUN_STATS.record_response})
         if response.status_code != 200:
             logger.error(
                 "Recieved status code: {} from prometheus, cannot complete the total time series request".format(
@@ -0,0 +1,187 @@
+import io
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import instrumentation
+import metrics_dashboard_extractor
+import multi_source
+import report_writer
+import timeseries_extractor
+from dashboard_store import DashboardStore
+from http_client import ConcurrentFetcher
+from query_scheduler import QueryScheduler
+
+logger = logging.getLogger()
+
+DEFAULT_WATCH_INTERVAL_SECONDS = 300
+DEFAULT_COUNTS_REFRESH_SECONDS = 3600
+DEFAULT_LISTEN_ADDRESS = '127.0.0.1:9465'
+
+
+def _parse_listen_address(listen) -> (str, int):
+    host, _, port = str(listen).rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class MetricsWatcher:
+    """Re-scans Grafana on a schedule, keeping the fetcher session, dashboard store, parsed expressions and
+    Prometheus series counts in memory between cycles, so each cycle only fetches and parses changed dashboards.
+
+    Series counts are kept per metric: new metrics are counted in the cycle they show up in, and all counts are
+    refreshed every counts_refresh_interval seconds.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        watch_config = config.get('watch') or {}
+        self.interval = float(watch_config.get('interval') or DEFAULT_WATCH_INTERVAL_SECONDS)
+        self.counts_refresh_interval = float(watch_config.get('prometheus_refresh_interval')
+                                             or DEFAULT_COUNTS_REFRESH_SECONDS)
+        self.listen = watch_config.get('listen') or DEFAULT_LISTEN_ADDRESS
+        if multi_source.is_multi_source(config):
+            raise ValueError('Watch mode supports a single grafana and prometheus block')
+        grafana_config = config['grafana']
+        self.fetcher = ConcurrentFetcher.from_config(grafana_config,
+                                                     metrics_dashboard_extractor.grafana_headers(grafana_config))
+        self.store = DashboardStore.from_config(config, grafana_config['endpoint'], keep_in_memory=True)
+        self.prometheus_config = config.get('prometheus') or {}
+        self.scheduler = QueryScheduler.from_config(self.prometheus_config) \
+            if self.prometheus_config.get('endpoint') else None
+        self.series_counts = {}
+        self.count_sources = {}
+        self.counted_metrics = set()
+        self.counts_updated_at = None
+        self.cycle = 0
+        self._latest = None
+        self._latest_report = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+        metrics_dashboard_extractor._load_expression_cache(config)
+
+    def latest(self, full_report=False):
+        with self._lock:
+            return self._latest_report if full_report else self._latest
+
+    def _count_timeseries(self, metrics):
+        endpoint = self.prometheus_config['endpoint']
+        interval = timeseries_extractor.extract_timeseries_interval(self.prometheus_config)
+        refresh = self.counts_updated_at is None or \
+            time.monotonic() - self.counts_updated_at >= self.counts_refresh_interval
+        to_count = list(metrics) if refresh else [metric for metric in metrics if metric not in self.counted_metrics]
+        if to_count:
+            logger.info(f'Counting the time series of {len(to_count)} {"" if refresh else "new "}metrics')
+            _, counts, sources, failed_metrics = timeseries_extractor._get_used_timeseries_count(
+                endpoint, interval, to_count, timeseries_extractor.extract_count_strategy(self.prometheus_config),
+                self.scheduler)
+            if refresh:
+                self.series_counts, self.count_sources, self.counted_metrics = {}, {}, set()
+                self.counts_updated_at = time.monotonic()
+            self.series_counts.update(counts)
+            self.count_sources.update(sources)
+            self.counted_metrics.update(set(to_count) - set(failed_metrics))
+        total_count = timeseries_extractor._get_total_timeseries_count(endpoint, interval)
+        used_counts = {metric: self.series_counts[metric] for metric in metrics if metric in self.series_counts}
+        return interval, total_count, sum(used_counts.values()), used_counts, \
+            {metric: self.count_sources[metric] for metric in used_counts}
+
+    def run_cycle(self) -> bool:
+        self.cycle += 1
+        started_at = time.time()
+        json_report = report_writer.JsonReportWriter(stream=io.StringIO())
+        writers = [json_report]
+        if (self.config.get('report') or {}).get('path'):
+            writers.append(report_writer.from_config(self.config))
+        report = report_writer.MultiReportWriter(writers)
+        try:
+            with instrumentation.instrumented_run_from_config(self.config):
+                metrics_dashboard_extractor.load_recording_rules(self.config)
+                metrics = metrics_dashboard_extractor.extract_grafana_metrics(self.config, self.fetcher, self.store,
+                                                                              report)
+                if self.scheduler is not None and metrics:
+                    report.write_timeseries(*self._count_timeseries(metrics))
+        except Exception:
+            # A long running watcher outlives any single bad dashboard, cache file or network error
+            logger.exception(f'Watch cycle {self.cycle} failed, keeping the previous results')
+            return False
+        finally:
+            report.close()
+        content = json.loads(json_report.stream.getvalue())
+        aggregate = dict(content['summary'], cycle=self.cycle, updated_at=started_at,
+                         duration=time.time() - started_at, dashboards_count=len(content['dashboards']),
+                         timeseries=content.get('timeseries'))
+        with self._lock:
+            self._latest = aggregate
+            self._latest_report = content
+        logger.info(f'Watch cycle {self.cycle} finished in {aggregate["duration"]:.1f}s, '
+                    f'{aggregate["distinct_metrics_count"]} distinct metrics')
+        return True
+
+    def serve(self):
+        host, port = _parse_listen_address(self.listen)
+        self._server = ThreadingHTTPServer((host, port), _AggregateHandler)
+        self._server.daemon_threads = True
+        self._server.watcher = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f'Serving the latest results at http://{host}:{self._server.server_address[1]}/')
+
+    def run_forever(self):
+        self.serve()
+        try:
+            while not self._stop.is_set():
+                cycle_started_at = time.monotonic()
+                self.run_cycle()
+                self._stop.wait(max(0.0, self.interval - (time.monotonic() - cycle_started_at)))
+        except KeyboardInterrupt:
+            logger.info('Stopping watch mode')
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.fetcher.close()
+        if self.scheduler is not None:
+            self.scheduler.close()
+        self.store.save()
+
+
+class _AggregateHandler(BaseHTTPRequestHandler):
+    """GET /aggregate (metrics, regex and series counts), /report (the full json report), /regex (the Prometheus
+    regex as plain text) and /healthz."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status_code, content, content_type='application/json'):
+        body = content.encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        watcher = self.server.watcher
+        path = self.path.split('?', 1)[0].rstrip('/') or '/aggregate'
+        if path == '/healthz':
+            return self._reply(200, json.dumps({'status': 'ok', 'cycle': watcher.cycle}))
+        if path not in ('/aggregate', '/report', '/regex'):
+            return self._reply(404, json.dumps({'error': f'unknown path {path}'}))
+        latest = watcher.latest(full_report=path == '/report')
+        if latest is None:
+            return self._reply(503, json.dumps({'error': 'the first scan has not finished yet'}))
+        if path == '/regex':
+            return self._reply(200, '\n'.join(latest['prometheus_regex']) + '\n', 'text/plain')
+        self._reply(200, json.dumps(latest))
+
+
+def watch(config: dict):
+    MetricsWatcher(config).run_forever()